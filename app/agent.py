@@ -1,49 +1,60 @@
-def generate_link(media):
-    tmdb_id = get_tmdb_id(media)
-    imdb_id = get_imdb_id(media)
-    tvdb_id = get_tvdb_id(media)
-    anidb_id = get_anidb_id(media)
-    if tmdb_id:
-        return f"https://www.themoviedb.org/movie/{tmdb_id}"
-    elif imdb_id:
-        return f'https://www.imdb.com/title/{imdb_id}/'
-    elif tvdb_id:
-        return f'https://www.thetvdb.com/series/{tvdb_id}/'
-    elif tvdb_id:
-        return f'https://anidb.net/anime/{anidb_id}/'
-    return None
-
-
-def get_tmdb_id(movie):
-    prefix = 'com.plexapp.agents.themoviedb://'
-    if movie.guid and movie.guid.startswith(prefix):
-        return movie.guid[len(prefix):].split('?')[0]
-    return None
-
-
-def get_imdb_id(movie):
-    prefix = 'com.plexapp.agents.imdb://'
-    if movie.guid and movie.guid.startswith(prefix):
-        return movie.guid[len(prefix):]
-    return None
-
-
-def get_tvdb_id(show):
-    prefix = 'com.plexapp.agents.tvdb://'
-    if show.guid and show.guid.startswith(prefix):
-        return show.guid[len(prefix):].split('?')[0]
-    return None
-
-
-def get_anidb_id(anime):
-    prefix = 'com.plexapp.agents.anidb://'
-    if anime.guid and anime.guid.startswith(prefix):
-        return anime.guid[len(prefix):].split('?')[0]
-    return None
-
-
-def get_lastfm_id(album):
-    prefix = 'com.plexapp.agents.lastfm://'
-    if album.guid and album.guid.startswith(prefix):
-        return album.guid[len(prefix):].split('?')[0]
+import re
+
+# Matches legacy agent GUIDs (com.plexapp.agents.imdb://tt0133093?lang=en),
+# Hama's prefixed ids (com.plexapp.agents.hama://anidb-23), new agent GUIDs
+# (plex://movie/5d776825880197001ec967c6) and the external ids Plex lists
+# under new agent items (imdb://tt0133093, tmdb://603, tvdb://81189).
+GUID_PATTERN = re.compile(
+    r'(?:com\.plexapp\.agents\.)?(?P<agent>[a-z]+)://(?:(?P<prefix>anidb|tvdb)\d*-)?(?P<id>[^?]*)')
+AGENTS = {
+    'themoviedb': 'tmdb',
+    'tmdb': 'tmdb',
+    'imdb': 'imdb',
+    'thetvdb': 'tvdb',
+    'tvdb': 'tvdb',
+    'anidb': 'anidb',
+    'lastfm': 'lastfm',
+    'plex': 'plex',
+}
+LINKS = [
+    ('tmdb', 'https://www.themoviedb.org/{type}/{id}'),
+    ('imdb', 'https://www.imdb.com/title/{id}/'),
+    ('tvdb', 'https://www.thetvdb.com/series/{id}/'),
+    ('anidb', 'https://anidb.net/anime/{id}/'),
+]
+
+
+def parse_guid(guid):
+    # Returns (source, id) for a GUID, or None for agents we don't link to.
+    match = GUID_PATTERN.match(guid or '')
+    if match is None:
+        return None
+    source = match.group('prefix') or AGENTS.get(match.group('agent'))
+    id = match.group('id')
+    if source is None or not id:
+        return None
+    if source != 'plex':
+        # Legacy TV agents append /season/episode to the series id.
+        id = id.split('/')[0]
+    return source, id
+
+
+def resolve_ids(item):
+    # Reads the item's GUID and the external ids returned by listings made
+    # with includeGuids=1. The raw XML is used because reading an empty
+    # guids list on a partial object would reload the item.
+    guids = [guid.attrib.get('id') for guid in item._data.iter('Guid')]
+    guids.append(item._data.attrib.get('guid'))
+    ids = {}
+    for guid in guids:
+        parsed = parse_guid(guid)
+        if parsed:
+            ids.setdefault(*parsed)
+    return ids
+
+
+def generate_link(ids, type='movie'):
+    for source, link in LINKS:
+        if source in ids:
+            return link.format(type='tv' if type == 'show' else 'movie', id=ids[source])
     return None
@@ -0,0 +1,206 @@
+import asyncio
+import itertools
+import logging
+import queue
+import threading
+import time
+import xml.etree.ElementTree as ET
+from urllib.parse import urlencode
+import plexapi
+from plexapi.utils import searchType
+from app.defaults import CONCURRENCY, RETRIES
+from app.metrics import metrics
+from app.session import RETRY_STATUSES, backoff_delay
+
+QUEUED_PAGES = 4
+CHUNK_SIZE = 64 * 1024
+DONE = object()
+
+
+def child_path(item, endpoint):
+    # The same endpoints Show.seasons(), Show.episodes(), Artist.tracks()
+    # and the children lookup in Export.fetch_artist_counts use.
+    if endpoint == 'children' and item.type == 'show':
+        return f"{item.key}/children?excludeAllLeaves=1"
+    return f"{item.key}/{endpoint}"
+
+
+class AsyncEngine:
+    # Talks to the Plex XML API with aiohttp on a background event loop.
+    # Listing pages and child counts are fetched concurrently under one
+    # semaphore, parsed incrementally as they arrive and turned into the
+    # same plexapi objects section.search() returns. Built pages reach the
+    # synchronous writers through a bounded queue, so a slow writer stalls
+    # the fetches instead of buffering the whole library. Failed requests
+    # are retried like those of the shared requests session.
+    def __init__(self, plex, concurrency=CONCURRENCY, retries=RETRIES) -> None:
+        try:
+            import aiohttp
+        except ImportError as e:
+            raise RuntimeError(
+                "The async engine needs aiohttp. Install it with: pip install 'plexport[async]'") from e
+        self.aiohttp = aiohttp
+        self.plex = plex
+        self.concurrency = concurrency
+        self.retries = retries
+
+    def iter_section(self, section, page_size, include_guids=True, lookups=None, counted=None, libtype=None,
+                     start=0, key=None):
+        # lookups(item) returns the child endpoints to count for an item and
+        # counted(item, counts) receives {endpoint: count} before the item is
+        # yielded. key replaces the listing request, e.g. to add filters.
+        pages = queue.Queue(maxsize=QUEUED_PAGES)
+        stop = threading.Event()
+
+        def put(page):
+            while not stop.is_set():
+                try:
+                    pages.put(page, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def run():
+            try:
+                asyncio.run(self.produce(section, page_size, libtype, start, key,
+                            include_guids, lookups, counted, put, stop))
+                put(DONE)
+            except BaseException as e:
+                put(e)
+
+        thread = threading.Thread(
+            target=metrics.bind(run), name=f"plexport-async-{section.key}", daemon=True)
+        thread.start()
+        try:
+            while True:
+                page = pages.get()
+                if page is DONE:
+                    break
+                if isinstance(page, BaseException):
+                    raise page
+                yield from page
+        finally:
+            stop.set()
+            thread.join()
+
+    async def produce(self, section, page_size, libtype, start, key, include_guids, lookups, counted, put, stop):
+        aiohttp = self.aiohttp
+        semaphore = asyncio.Semaphore(self.concurrency)
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        timeout = aiohttp.ClientTimeout(
+            sock_connect=self.plex._timeout, sock_read=self.plex._timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout,
+                                         headers=dict(plexapi.BASE_HEADERS)) as session:
+            path = key
+            if path is None:
+                params = {'includeGuids': int(include_guids)}
+                if libtype is not None:
+                    params['type'] = searchType(libtype)
+                path = f"/library/sections/{section.key}/all?" + urlencode(params)
+
+            def fetch_page(start):
+                return asyncio.ensure_future(self.fetch(session, semaphore, path, start, page_size))
+
+            container, elements = await fetch_page(start)
+            total = int(container.get('totalSize') or container.get(
+                'size') or len(elements))
+            starts = iter(range(start + len(elements), total, page_size)) if len(
+                elements) >= page_size else iter(())
+            # Keep a few pages in flight ahead of the one being built.
+            ahead = [fetch_page(start)
+                     for _, start in zip(range(QUEUED_PAGES), starts)]
+            try:
+                while True:
+                    items = self.build_items(section, path, container, elements)
+                    if lookups is not None:
+                        await self.count_children(session, semaphore, items, lookups, counted)
+                    await asyncio.to_thread(put, items)
+                    if stop.is_set() or not ahead:
+                        return
+                    container, elements = await ahead.pop(0)
+                    start = next(starts, None)
+                    if start is not None:
+                        ahead.append(fetch_page(start))
+            finally:
+                for page in ahead:
+                    page.cancel()
+
+    def build_items(self, section, path, container, elements):
+        library_section_id = container.get('librarySectionID')
+        items = []
+        for element in elements:
+            item = section._buildItemOrNone(element, initpath=path)
+            if item is None:
+                continue
+            # Attributes missing from the listing must not reload the item
+            # from the event loop thread.
+            item._autoReload = False
+            if library_section_id:
+                item.librarySectionID = int(library_section_id)
+            items.append(item)
+        return items
+
+    async def count_children(self, session, semaphore, items, lookups, counted):
+        async def count(item, endpoint):
+            container, _ = await self.fetch(session, semaphore, child_path(item, endpoint), 0, 0)
+            return int(container.get('totalSize') or container.get('size') or 0)
+
+        def record(counts):
+            for item, values in counts.values():
+                counted(item, values)
+
+        # lookups and counted read and write the sqlite metadata cache, so
+        # they run on a worker thread instead of blocking the event loop.
+        requests = await asyncio.to_thread(
+            lambda: [(item, endpoint) for item in items for endpoint in lookups(item)])
+        results = await asyncio.gather(*(count(item, endpoint) for item, endpoint in requests))
+        counts = {}
+        for (item, endpoint), result in zip(requests, results):
+            counts.setdefault(item.ratingKey, (item, {}))[1][endpoint] = result
+        if counts:
+            await asyncio.to_thread(record, counts)
+
+    async def fetch(self, session, semaphore, path, start, size):
+        # Returns the MediaContainer element and its children, parsed while
+        # the body streams in.
+        for attempt in itertools.count():
+            try:
+                return await self.fetch_once(session, semaphore, path, start, size)
+            except (self.aiohttp.ClientError, asyncio.TimeoutError) as e:
+                status = getattr(e, 'status', None)
+                if attempt >= self.retries or (status is not None and status not in RETRY_STATUSES):
+                    raise
+                delay = backoff_delay(attempt)
+                logging.debug(
+                    f"Retrying {path} ({start}+{size}) in {delay:.1f}s: {e!r}")
+                await asyncio.sleep(delay)
+
+    async def fetch_once(self, session, semaphore, path, start, size):
+        headers = {'X-Plex-Container-Start': str(start),
+                   'X-Plex-Container-Size': str(size)}
+        async with semaphore:
+            started = time.perf_counter()
+            async with session.get(self.plex.url(path, includeToken=True), headers=headers) as response:
+                response.raise_for_status()
+                parser = ET.XMLPullParser(events=('start', 'end'))
+                container = None
+                elements = []
+                depth = 0
+                received = 0
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    received += len(chunk)
+                    parser.feed(chunk)
+                    for event, element in parser.read_events():
+                        if event == 'start':
+                            if container is None:
+                                container = element
+                            depth += 1
+                        else:
+                            depth -= 1
+                            if depth == 1:
+                                elements.append(element)
+                parser.close()
+            elapsed = time.perf_counter() - started
+        metrics.request(received, elapsed)
+        logging.debug(f"Fetched {path} ({start}+{len(elements)}) in {elapsed:.3f}s")
+        return container, elements
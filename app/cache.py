@@ -0,0 +1,93 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from app.defaults import CACHE_SIZE_MB
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    endpoint TEXT NOT NULL,
+    rating_key INTEGER NOT NULL,
+    updated_at INTEGER,
+    value TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (endpoint, rating_key)
+);
+CREATE INDEX IF NOT EXISTS entries_last_used ON entries(last_used);
+"""
+
+
+class MetadataCache:
+    # On-disk cache of Plex responses keyed by endpoint and ratingKey. An
+    # entry is only valid while the parent item's version (updatedAt and
+    # child counts, see app.state.item_version) is unchanged, which the
+    # updated_at column holds. The least recently used entries are evicted
+    # once max_bytes is exceeded.
+    def __init__(self, path, max_bytes=CACHE_SIZE_MB * 1024 ** 2) -> None:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.executescript(SCHEMA)
+        self.lock = threading.Lock()
+        self.max_bytes = max_bytes
+        self.size = self.conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def for_server(cls, plex, cache_dir, max_bytes=CACHE_SIZE_MB * 1024 ** 2):
+        return cls(os.path.join(cache_dir, f"{plex.machineIdentifier}.sqlite"), max_bytes)
+
+    def get(self, endpoint, rating_key, version):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT updated_at, value FROM entries WHERE endpoint = ? AND rating_key = ?",
+                (endpoint, rating_key)).fetchone()
+            if row is None or version is None or row[0] != version:
+                self.misses += 1
+                return None
+            self.hits += 1
+            with self.conn:
+                self.conn.execute(
+                    "UPDATE entries SET last_used = ? WHERE endpoint = ? AND rating_key = ?",
+                    (time.time(), endpoint, rating_key))
+        return json.loads(row[1])
+
+    def set(self, endpoint, rating_key, version, value):
+        if version is None:
+            return
+        value = json.dumps(value)
+        with self.lock, self.conn:
+            previous = self.conn.execute(
+                "SELECT size FROM entries WHERE endpoint = ? AND rating_key = ?",
+                (endpoint, rating_key)).fetchone()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                (endpoint, rating_key, version, value, len(value), time.time()))
+            self.size += len(value) - (previous[0] if previous else 0)
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        # Drops least recently used entries until the cache is 90% full.
+        target = self.max_bytes * 0.9
+        rows = self.conn.execute(
+            "SELECT endpoint, rating_key, size FROM entries ORDER BY last_used")
+        expired = []
+        for endpoint, rating_key, size in rows:
+            if self.size <= target:
+                break
+            expired.append((endpoint, rating_key))
+            self.size -= size
+        self.conn.executemany(
+            "DELETE FROM entries WHERE endpoint = ? AND rating_key = ?", expired)
+        logging.debug(f"Evicted {len(expired)} entries from metadata cache")
+
+    def close(self):
+        logging.info(
+            f"Metadata cache: {self.hits} hits, {self.misses} misses")
+        self.conn.close()
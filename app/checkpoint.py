@@ -0,0 +1,63 @@
+import json
+import logging
+import os
+import time
+from app.metrics import write_atomic
+
+CHECKPOINT_ROWS = 1000
+CHECKPOINT_INTERVAL = 30.0
+
+
+def partial_filename(filename):
+    # Writers fill this file and only rename it over filename once the
+    # section is complete. The extension is kept so openpyxl can read a
+    # partial workbook back.
+    root, extension = os.path.splitext(filename)
+    return f"{root}.partial{extension}"
+
+
+class Checkpoint:
+    # Records how far the export of one section got: the number of rows in
+    # the partial outputs, the ratingKey of the last one and, per format, the
+    # byte offset those rows end at (None for XLSX and snapshots).
+    def __init__(self, path, headers, formats, filters=None, rows=CHECKPOINT_ROWS,
+                 interval=CHECKPOINT_INTERVAL) -> None:
+        self.path = path
+        self.headers = list(headers)
+        self.formats = sorted(formats)
+        # Filter values as they are saved: dates and sets become strings.
+        self.filters = json.loads(json.dumps(filters or {}, sort_keys=True, default=str))
+        self.rows = rows
+        self.interval = interval
+        self.pending = 0
+        self.last_saved = time.monotonic()
+
+    def load(self):
+        # Returns the saved checkpoint if it was written for the same columns,
+        # formats and filters.
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, encoding='utf-8') as file:
+            data = json.load(file)
+        if data.get('headers') != self.headers or data.get('formats') != self.formats:
+            return None
+        if data.get('filters', {}) != self.filters:
+            logging.warning(
+                f"The checkpoint in {self.path} was written with other filters, starting over")
+            return None
+        return data
+
+    def due(self):
+        self.pending += 1
+        return self.pending >= self.rows or time.monotonic() - self.last_saved >= self.interval
+
+    def save(self, rows, rating_key, positions):
+        write_atomic(self.path, json.dumps({'headers': self.headers, 'formats': self.formats,
+                                            'filters': self.filters, 'rows': rows,
+                                            'rating_key': rating_key, 'positions': positions}))
+        self.pending = 0
+        self.last_saved = time.monotonic()
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
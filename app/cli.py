@@ -1,10 +1,117 @@
 import argparse
+import datetime
+import importlib
+import re
 from dotenv import load_dotenv
-from app.command import export
+from app.columns import column_names
 from app.log import setup_logging
+from app.defaults import (CACHE_SIZE_MB, COMPRESSIONS, CONCURRENCY, DEBOUNCE, FORMATS, PAGE_SIZE, POLL_INTERVAL,
+                          RETRIES, STATS_FORMATS, TIMEOUT, TOP)
 from app.environment import install_missing_packages, set_environment
 
 
+def lazy(module, name):
+    # Subcommands import their dependencies (plexapi, openpyxl, ...) only
+    # when they actually run.
+    def command(args):
+        return getattr(importlib.import_module(module), name)(args)
+    return command
+
+
+export = lazy('app.command', 'export')
+watch = lazy('app.command', 'watch')
+stats = lazy('app.command', 'stats')
+
+
+def format_list(value, choices=FORMATS):
+    formats = list(dict.fromkeys(name.strip() for name in value.split(',') if name.strip()))
+    unknown = [name for name in formats if name not in choices]
+    if unknown or not formats:
+        raise argparse.ArgumentTypeError(
+            f"invalid format {', '.join(unknown) or repr(value)} (choose from {', '.join(choices)})")
+    return formats
+
+
+def stats_format_list(value):
+    return format_list(value, STATS_FORMATS)
+
+
+def comma_list(value):
+    return [entry.strip() for entry in value.split(',') if entry.strip()]
+
+
+def column_list(value):
+    columns = comma_list(value)
+    known = column_names()
+    unknown = [name for name in columns if name not in known]
+    if unknown:
+        raise argparse.ArgumentTypeError(
+            f"invalid column {', '.join(unknown)} (choose from {', '.join(known)})")
+    return columns
+
+
+SINCE_UNITS = {'m': 'minutes', 'h': 'hours', 'd': 'days', 'w': 'weeks'}
+
+
+def since(value):
+    # A date, a datetime or an age like 12h, 7d, 2w or 1y.
+    match = re.fullmatch(r'(\d+)\s*([mhdwy])', value.strip())
+    if match:
+        amount, unit = int(match.group(1)), match.group(2)
+        if unit == 'y':
+            amount, unit = amount * 365, 'd'
+        return datetime.datetime.now().replace(microsecond=0) - datetime.timedelta(**{SINCE_UNITS[unit]: amount})
+    try:
+        return datetime.datetime.fromisoformat(value.strip())
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"invalid time {value!r} (use e.g. 2024-01-31, 2024-01-31T12:00 or 7d)")
+
+
+def year_list(value):
+    years = []
+    for entry in comma_list(value):
+        match = re.fullmatch(r'(\d{4})(?:\s*-\s*(\d{4}))?', entry)
+        if not match:
+            raise argparse.ArgumentTypeError(
+                f"invalid year {entry!r} (use e.g. 1999 or 1990-1999)")
+        first = int(match.group(1))
+        years.extend(range(first, int(match.group(2) or first) + 1))
+    return list(dict.fromkeys(years))
+
+
+def resolution_list(value):
+    # 1080p, 1080 and 4K all name the resolutions Plex reports.
+    return [entry.lower().removesuffix('p') for entry in comma_list(value)]
+
+
+def positive_int(value):
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"invalid value {value!r} (use a whole number above 0)")
+    return number
+
+
+def add_output_arguments(parser):
+    parser.add_argument('--compress', choices=COMPRESSIONS,
+                        help='Compress csv and jsonl outputs and list them in a '
+                        '<section>.<format>.manifest.json (zstd needs zstandard)')
+    parser.add_argument('--shard-rows', type=positive_int,
+                        help='Split csv and jsonl outputs into shards of at most this many rows')
+    parser.add_argument('--shard-size', type=positive_int,
+                        help='Split csv and jsonl outputs into shards of about this many MiB before compression')
+
+
+def add_connection_arguments(parser):
+    parser.add_argument('--timeout', type=float, default=TIMEOUT,
+                        help='Seconds to wait for each Plex response before retrying it')
+    parser.add_argument('--retries', type=int, default=RETRIES,
+                        help='Times to retry a request after a connection error, timeout or 5xx response')
+
+
 def cli_entry():
     initialization()
     parser = argparse.ArgumentParser(
@@ -14,18 +121,113 @@ def cli_entry():
     export_parser = subparsers.add_parser(
         'export', help='Export Plex library items.')
     export_parser.set_defaults(func=export)
+    export_parser.add_argument('--format', default='csv', type=format_list,
+                               help='Comma separated output formats for exported sections, written from a '
+                               f'single pass over the server, e.g. csv,xlsx (choose from {", ".join(FORMATS)})')
+    export_parser.add_argument('--workers', type=int, default=4,
+                               help='Number of items to fetch details for concurrently')
+    export_parser.add_argument('--engine', default='threads', choices=['threads', 'async'],
+                               help='Fetch with plexapi on worker threads, or with aiohttp on an event loop')
+    export_parser.add_argument('--concurrency', type=int, default=CONCURRENCY,
+                               help='Maximum number of requests in flight with the async engine')
+    export_parser.add_argument('--no-bulk-counts', dest='bulk_counts', action='store_false',
+                               help='Count seasons, episodes, albums and tracks with one query per item')
+    export_parser.add_argument('--page-size', type=int, default=PAGE_SIZE,
+                               help='Number of items to request per page of a library section')
+    export_parser.add_argument('--incremental', action='store_true',
+                               help='Only fetch details for items added or changed since the last export')
+    export_parser.add_argument('--resume', action='store_true',
+                               help='Continue interrupted exports from their last checkpoint (SQLite resumes on its own)')
+    export_parser.add_argument('--cache', default=True, action=argparse.BooleanOptionalAction,
+                               help='Cache per-item Plex responses on disk between runs')
+    export_parser.add_argument('--cache-size', type=int, default=CACHE_SIZE_MB,
+                               help='Maximum size of the metadata cache in MiB')
+    export_parser.add_argument('--music', default='artists', choices=['artists', 'tracks'],
+                               help='Export music sections with one row per artist or one row per track')
+    export_parser.add_argument('--columns', type=column_list,
+                               help='Comma separated columns to export, e.g. name,year,link (default: all). '
+                               'Columns that need full items, like producers, cost one request per item')
+    filter_group = export_parser.add_argument_group(
+        'filters', 'A filtered export writes the matching items of each section to outputs named after '
+        'the filters, e.g. "Movies (year 2024).csv", and upserts them into SQLite without deleting other '
+        'items. Sections a filter does not apply to are skipped.')
+    filter_group.add_argument('--added-since', type=since,
+                              help='Only export items added since a date, a time or an age like 7d or 12h')
+    filter_group.add_argument('--updated-since', type=since,
+                              help='Only export items changed since a date, a time or an age like 7d or 12h')
+    filter_group.add_argument('--year', type=year_list,
+                              help='Only export items from these comma separated years or ranges, e.g. 1990-1999,2024')
+    filter_group.add_argument('--genre', type=comma_list,
+                              help='Only export items with one of these comma separated genres')
+    filter_group.add_argument('--resolution', type=resolution_list,
+                              help='Only export movies and shows in one of these resolutions, e.g. 4k,1080; '
+                              'music sections are skipped')
+    filter_group.add_argument('--unwatched', action='store_true', default=None,
+                              help='Only export unwatched movies, shows and tracks; music sections exported '
+                              'by artist are skipped')
+    export_parser.add_argument('--match', default=None, action=argparse.BooleanOptionalAction,
+                               help='Report duplicate and missing titles across servers and sections '
+                               '(default: on when PLEX_URL lists several servers)')
+    add_output_arguments(export_parser)
+    add_connection_arguments(export_parser)
+    export_parser.add_argument('--metrics',
+                               help='Path of the JSON run summary (default: <EXPORT_DIR>/metrics.json)')
+    export_parser.add_argument('--prometheus',
+                               help='Also write run metrics to this Prometheus textfile collector file')
+
+    watch_parser = subparsers.add_parser(
+        'watch', help='Keep exports current by applying library changes as they happen.')
+    watch_parser.set_defaults(func=watch)
+    watch_parser.add_argument('--format', default='csv', type=format_list,
+                              help=f'Comma separated output formats to keep current (choose from {", ".join(FORMATS)})')
+    watch_parser.add_argument('--columns', type=column_list,
+                              help='Comma separated columns to export, e.g. name,year,link (default: all)')
+    watch_parser.add_argument('--music', default='artists', choices=['artists', 'tracks'],
+                              help='Export music sections with one row per artist or one row per track')
+    watch_parser.add_argument('--workers', type=int, default=4,
+                              help='Number of items to fetch details for concurrently')
+    watch_parser.add_argument('--page-size', type=int, default=PAGE_SIZE,
+                              help='Number of items to request per page of a library section')
+    watch_parser.add_argument('--cache', default=True, action=argparse.BooleanOptionalAction,
+                              help='Cache per-item Plex responses on disk between runs')
+    watch_parser.add_argument('--cache-size', type=int, default=CACHE_SIZE_MB,
+                              help='Maximum size of the metadata cache in MiB')
+    watch_parser.add_argument('--debounce', type=float, default=DEBOUNCE,
+                              help='Seconds without further changes before a batch of changes is applied')
+    watch_parser.add_argument('--poll-interval', type=float, default=POLL_INTERVAL,
+                              help='Seconds between updatedAt polls when library notifications are unavailable')
+    add_output_arguments(watch_parser)
+    add_connection_arguments(watch_parser)
+
+    stats_parser = subparsers.add_parser(
+        'stats', help='Report storage, bitrate and duplicate statistics over every media file.')
+    stats_parser.set_defaults(func=stats)
+    stats_parser.add_argument('--format', default='json', type=stats_format_list,
+                              help=f'Comma separated report formats written to EXPORT_DIR/stats.<format> '
+                              f'(choose from {", ".join(STATS_FORMATS)})')
+    stats_parser.add_argument('--top', type=int, default=TOP,
+                              help='Number of largest files and duplicated items to list per section')
+    stats_parser.add_argument('--page-size', type=int, default=PAGE_SIZE,
+                              help='Number of items to request per page of a library section')
+    stats_parser.add_argument('--save-parts', action='store_true',
+                              help='Also save the media files of each section as "<section> Parts.snapshot"')
+    stats_parser.add_argument('--from-parts', action='store_true',
+                              help='Report on the saved parts snapshots instead of the server')
+    add_connection_arguments(stats_parser)
 
     init_parser = subparsers.add_parser(
         'init', help='Initialize environment variables')
     init_parser.set_defaults(func=set_environment)
-    init_parser.add_argument('--plex-url', help='URL of the Plex server')
-    init_parser.add_argument('--plex-token', help='Plex authentication token')
+    init_parser.add_argument('--plex-url', help='URL of the Plex server, or several URLs separated by commas')
+    init_parser.add_argument('--plex-token', help='Plex authentication token, or one token per URL separated by commas')
     init_parser.add_argument(
         '--export-dir', default='exports', help='Directory for export files')
     init_parser.add_argument('--log-dir', default='logs',
                              help='Directory for log files')
     init_parser.add_argument(
         '--log-level', default='info', help='Log level for the application')
+    init_parser.add_argument('--log-queue', choices=['true', 'false'],
+                             help='Format and write logs on a background thread')
     init_parser.add_argument('--sections', help='Sections to be scanned')
 
     parser.set_defaults(func=export)
@@ -0,0 +1,168 @@
+from collections import namedtuple
+from app.agent import generate_link
+
+# fields names what a column needs besides the listing attributes:
+#   ids     external ids resolved from the includeGuids listing
+#   counts  child and leaf counts (seasons/episodes, albums/tracks)
+#   detail  the full item, which costs one request per partial item
+#   album   the track's album (title, year) from the section's album listing
+#   artist  the track's artist (title, genres) from the artist listing
+Column = namedtuple('Column', ['header', 'extract', 'fields'])
+
+
+def column(header, extract, *fields):
+    return Column(header, extract, frozenset(fields))
+
+
+def tags(values):
+    return ', '.join(tag.tag for tag in values) if values else None
+
+
+def first_media(item):
+    return item.media[0] if item.media else None
+
+
+def first_part(item):
+    media = first_media(item)
+    return media.parts[0] if media and media.parts else None
+
+
+def media_attribute(name):
+    def extract(item, data):
+        media = first_media(item)
+        return getattr(media, name) if media else None
+    return extract
+
+
+def size_mib(item, data):
+    part = first_part(item)
+    return round(part.size / (1024 ** 2), 2) if part and part.size is not None else None
+
+
+def duration_mins(item, data):
+    # Convert from ms to mins
+    return item.duration // 60000 if item.duration is not None else None
+
+
+def duration_secs(item, data):
+    return item.duration // 1000 if item.duration is not None else None
+
+
+def album_year(item, data):
+    album = data['album']
+    return album[1] if album else None
+
+
+def artist_genres(item, data):
+    artist = data['artist']
+    return artist[1] if artist else None
+
+
+def file(item, data):
+    part = first_part(item)
+    return part.file if part else None
+
+
+def link(item, data):
+    return generate_link(data['ids'], item.type)
+
+
+COLUMNS = {
+    'movie': {
+        'name': column('Name', lambda item, data: item.title),
+        'year': column('Year', lambda item, data: item.year),
+        'link': column('Link', link, 'ids'),
+        'rating': column('Rating', lambda item, data: item.rating),
+        'summary': column('Summary', lambda item, data: item.summary),
+        'duration': column('Duration (mins)', duration_mins),
+        'genres': column('Genres', lambda item, data: tags(item.genres)),
+        'directors': column('Directors', lambda item, data: tags(item.directors)),
+        'writers': column('Writers', lambda item, data: tags(item.writers)),
+        'actors': column('Actors', lambda item, data: tags(item.actors)),
+        'resolution': column('Resolution', media_attribute('videoResolution')),
+        'codec': column('Codec', media_attribute('videoCodec')),
+        'container': column('Container', media_attribute('container')),
+        'bitrate': column('Bitrate', media_attribute('bitrate')),
+        'size': column('Size (MiB)', size_mib),
+        'audio-channels': column('Audio Channels', media_attribute('audioChannels')),
+        'added-at': column('Added At', lambda item, data: item.addedAt),
+        'updated-at': column('Updated At', lambda item, data: item.updatedAt),
+        # Producers are only returned with the full item.
+        'producers': column('Producers', lambda item, data: tags(item.producers), 'detail'),
+    },
+    'show': {
+        'name': column('Name', lambda item, data: item.title),
+        'year': column('Year', lambda item, data: item.year),
+        'link': column('Link', link, 'ids'),
+        'rating': column('Rating', lambda item, data: item.rating),
+        'summary': column('Summary', lambda item, data: item.summary),
+        'genres': column('Genres', lambda item, data: tags(item.genres)),
+        'seasons': column('Total Seasons', lambda item, data: data['counts'][0], 'counts'),
+        'episodes': column('Total Episodes', lambda item, data: data['counts'][1], 'counts'),
+        'added-at': column('Added At', lambda item, data: item.addedAt),
+        'updated-at': column('Updated At', lambda item, data: item.updatedAt),
+    },
+    'artist': {
+        'name': column('Artist Name', lambda item, data: item.title),
+        'genres': column('Genres', lambda item, data: tags(item.genres)),
+        'albums': column('Albums', lambda item, data: data['counts'][0], 'counts'),
+        'tracks': column('Tracks', lambda item, data: data['counts'][1], 'counts'),
+        'added-at': column('Added At', lambda item, data: item.addedAt),
+        'updated-at': column('Updated At', lambda item, data: item.updatedAt),
+    },
+    # Rows of --music tracks exports.
+    'track': {
+        'artist': column('Artist', lambda item, data: item.grandparentTitle),
+        'album': column('Album', lambda item, data: item.parentTitle),
+        'album-year': column('Album Year', album_year, 'album'),
+        'disc': column('Disc', lambda item, data: item.parentIndex),
+        'track-number': column('Track', lambda item, data: item.index),
+        'title': column('Title', lambda item, data: item.title),
+        'duration': column('Duration (secs)', duration_secs),
+        'codec': column('Codec', media_attribute('audioCodec')),
+        'bitrate': column('Bitrate', media_attribute('bitrate')),
+        'container': column('Container', media_attribute('container')),
+        'size': column('Size (MiB)', size_mib),
+        'file': column('File', file),
+        'artist-genres': column('Artist Genres', artist_genres, 'artist'),
+        'added-at': column('Added At', lambda item, data: item.addedAt),
+        'updated-at': column('Updated At', lambda item, data: item.updatedAt),
+    },
+}
+DEFAULT_COLUMNS = {
+    'movie': ['name', 'year', 'link', 'rating', 'summary', 'duration', 'genres', 'directors', 'writers',
+              'actors', 'resolution', 'codec', 'container', 'bitrate', 'size', 'audio-channels',
+              'added-at', 'updated-at'],
+    'show': ['name', 'year', 'link', 'rating', 'summary', 'genres', 'seasons', 'episodes',
+             'added-at', 'updated-at'],
+    'artist': ['name', 'genres', 'albums', 'tracks', 'added-at', 'updated-at'],
+    'track': ['artist', 'album', 'album-year', 'disc', 'track-number', 'title', 'duration', 'codec',
+              'bitrate', 'container', 'size', 'added-at'],
+}
+
+
+def select_columns(section_type, names=None):
+    # Names missing from a section type are skipped so one --columns list
+    # can be used for every section.
+    available = COLUMNS[section_type]
+    if not names:
+        names = DEFAULT_COLUMNS[section_type]
+    return [available[name] for name in names if name in available]
+
+
+def column_names():
+    # Every column name of any section type, for --columns.
+    return sorted({name for columns in COLUMNS.values() for name in columns})
+
+
+def required_fields(columns):
+    return frozenset().union(*(column.fields for column in columns))
+
+
+def compile_row(columns):
+    # Builds rows as tuples straight from the selected extractors.
+    extractors = tuple(column.extract for column in columns)
+
+    def build(item, data):
+        return tuple([extract(item, data) for extract in extractors])
+    return build
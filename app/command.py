@@ -1,19 +1,210 @@
 import logging
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from app.aio import AsyncEngine
+from app.cache import MetadataCache
+from app.defaults import (CACHE_SIZE_MB, CONCURRENCY, DEBOUNCE, PAGE_SIZE, POLL_INTERVAL, RETRIES, TIMEOUT,
+                          TOP)
 from app.export import Export
-from app.plex import connect_plex
+from app.filters import FILTERS
+from app.match import match as match_items
+from app.metrics import metrics
+from app.plex import connect_servers, server_names
+from app.session import new_session
+from app.shards import SHARDED_FORMATS, Output, check_compression
+from app.stats import saved_stats, section_stats, write_reports
+from app.watch import Watcher
+
+
+def open_session(args):
+    # Sized for every thread that can talk to a server at once: the item
+    # workers, the page prefetch and the main thread.
+    session = new_session(getattr(args, "workers", 4) + 2,
+                          retries=getattr(args, "retries", RETRIES))
+    metrics.attach(session)
+    return session
+
+
+def output_options(args):
+    # Plain files unless compression or sharding was asked for.
+    compression = getattr(args, "compress", None)
+    shard_rows = getattr(args, "shard_rows", None)
+    shard_size = getattr(args, "shard_size", None)
+    if compression is None and shard_rows is None and shard_size is None:
+        return None
+    compression = compression or "none"
+    check_compression(compression)
+    return Output(compression, shard_rows, shard_size * 1024 ** 2 if shard_size else None)
 
 
 def export(args):
-    plex = connect_plex()
+    columns = getattr(args, "columns", None)
+    output = output_options(args)
+    session = open_session(args)
+    servers = connect_servers(session, timeout=getattr(args, "timeout", TIMEOUT))
+    if not servers:
+        logging.error("No Plex server to export from.")
+        return
     EXPORT_DIR = os.environ.get("EXPORT_DIR", "exports")
     if EXPORT_DIR == "exports":
         logging.warning(
             "No custom EXPORT_DIR set. Defaulting to exports directory.")
     if not os.path.exists(EXPORT_DIR):
         os.makedirs(EXPORT_DIR)
+    metrics.reset()
+    # With several servers each one exports to its own subdirectory.
+    names = server_names(servers) if len(servers) > 1 else [None]
+    match = getattr(args, "match", None)
+    if match is None:
+        match = len(servers) > 1
+    caches = []
+    stop = threading.Event()
+    try:
+        workers = getattr(args, "workers", 4)
+        bulk_counts = getattr(args, "bulk_counts", True)
+        page_size = getattr(args, "page_size", PAGE_SIZE)
+        incremental = getattr(args, "incremental", False)
+        formats = getattr(args, "format", ["csv"])
+        if output is not None and not any(format in SHARDED_FORMATS for format in formats):
+            logging.warning("--compress and --shard-* only apply to csv and jsonl outputs.")
+        music = getattr(args, "music", "artists")
+        resume = getattr(args, "resume", False)
+        filters = {name: getattr(args, name) for name in FILTERS
+                   if getattr(args, name, None) is not None}
+        exports = []
+        for plex, name in zip(servers, names):
+            cache = None
+            if getattr(args, "cache", True):
+                CACHE_DIR = os.environ.get("CACHE_DIR", "cache")
+                cache_size = getattr(args, "cache_size", CACHE_SIZE_MB)
+                cache = MetadataCache.for_server(
+                    plex, CACHE_DIR, cache_size * 1024 ** 2)
+                caches.append(cache)
+            engine = None
+            if getattr(args, "engine", "threads") == "async":
+                engine = AsyncEngine(plex, getattr(args, "concurrency", CONCURRENCY),
+                                     retries=getattr(args, "retries", RETRIES))
+            export_dir = os.path.join(EXPORT_DIR, name) if name else EXPORT_DIR
+            os.makedirs(export_dir, exist_ok=True)
+            exports.append(Export(plex, export_dir, workers=workers, bulk_counts=bulk_counts,
+                                  page_size=page_size, incremental=incremental, cache=cache,
+                                  columns=columns, engine=engine, name=name, match=match,
+                                  music=music, resume=resume, filters=filters, output=output,
+                                  stop=stop))
+        if len(exports) == 1:
+            exports[0].export(formats=formats)
+        else:
+            executor = ThreadPoolExecutor(max_workers=len(exports))
+            futures = [executor.submit(export.export, formats=formats) for export in exports]
+            try:
+                for future in futures:
+                    future.result()
+            except KeyboardInterrupt:
+                # The exports stop at their next item and save their
+                # checkpoints; the process exits once they have.
+                stop.set()
+                raise
+            finally:
+                executor.shutdown(wait=False)
+        if match:
+            match_items([item for export in exports for item in export.match_items], EXPORT_DIR)
+    except KeyboardInterrupt:
+        logging.warning(
+            "Ctrl + C User interrupt. Shutting down gracefully...")
+    finally:
+        for cache in caches:
+            cache.close()
+        metrics_file = getattr(args, "metrics", None) or os.path.join(
+            EXPORT_DIR, "metrics.json")
+        metrics.write_json(metrics_file)
+        logging.info(f"Wrote run metrics to {metrics_file}")
+        prometheus_file = getattr(args, "prometheus", None)
+        if prometheus_file:
+            metrics.write_prometheus(prometheus_file)
+
+
+def watch(args):
+    # One connection per server stays open; exports are brought up to date
+    # once and then patched as the libraries change.
+    columns = getattr(args, "columns", None)
+    output = output_options(args)
+    servers = connect_servers(open_session(args), timeout=getattr(args, "timeout", TIMEOUT))
+    if not servers:
+        logging.error("No Plex server to watch.")
+        return
+    EXPORT_DIR = os.environ.get("EXPORT_DIR", "exports")
+    names = server_names(servers) if len(servers) > 1 else [None]
+    formats = getattr(args, "format", ["csv"])
+    caches = []
+    stop = threading.Event()
+    threads = []
+    try:
+        watchers = []
+        for plex, name in zip(servers, names):
+            cache = None
+            if getattr(args, "cache", True):
+                CACHE_DIR = os.environ.get("CACHE_DIR", "cache")
+                cache = MetadataCache.for_server(
+                    plex, CACHE_DIR, getattr(args, "cache_size", CACHE_SIZE_MB) * 1024 ** 2)
+                caches.append(cache)
+            export_dir = os.path.join(EXPORT_DIR, name) if name else EXPORT_DIR
+            os.makedirs(export_dir, exist_ok=True)
+            export = Export(plex, export_dir, workers=getattr(args, "workers", 4),
+                            page_size=getattr(args, "page_size", PAGE_SIZE), incremental=True, cache=cache,
+                            columns=columns, name=name, music=getattr(args, "music", "artists"), output=output)
+            watchers.append(Watcher(export, formats, debounce=getattr(args, "debounce", DEBOUNCE),
+                                    poll_interval=getattr(args, "poll_interval", POLL_INTERVAL)))
+        for watcher in watchers:
+            watcher.sync()
+            if watcher.export.interrupted:
+                return
+        for watcher in watchers:
+            thread = threading.Thread(target=watcher.run, args=(stop,),
+                                      name=f"plexport-watch-{watcher.label}", daemon=True)
+            thread.start()
+            threads.append(thread)
+        logging.info(f"Watching {len(watchers)} server(s) for library changes. Press Ctrl + C to stop.")
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(timeout=1)
+    except KeyboardInterrupt:
+        logging.warning(
+            "Ctrl + C User interrupt. Shutting down gracefully...")
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+        for cache in caches:
+            cache.close()
+
+
+def stats(args):
+    EXPORT_DIR = os.environ.get("EXPORT_DIR", "exports")
+    formats = getattr(args, "format", ["json"])
+    top = getattr(args, "top", TOP)
+    if getattr(args, "from_parts", False):
+        reports = saved_stats(EXPORT_DIR, top)
+        if not reports:
+            logging.error(f"No saved parts snapshots in {EXPORT_DIR}. Run plexport stats --save-parts first.")
+            return
+        write_reports(reports, EXPORT_DIR, formats)
+        return
+    session = open_session(args)
+    servers = connect_servers(session, timeout=getattr(args, "timeout", TIMEOUT))
+    if not servers:
+        logging.error("No Plex server to report on.")
+        return
+    names = server_names(servers) if len(servers) > 1 else [None]
     try:
-        Export(plex, EXPORT_DIR).export(format="csv")
+        for plex, name in zip(servers, names):
+            export_dir = os.path.join(EXPORT_DIR, name) if name else EXPORT_DIR
+            os.makedirs(export_dir, exist_ok=True)
+            export = Export(plex, export_dir, name=name)
+            reports = section_stats(plex, export.sections(), export_dir, top=top,
+                                    page_size=getattr(args, "page_size", PAGE_SIZE),
+                                    save_parts=getattr(args, "save_parts", False))
+            write_reports(reports, export_dir, formats)
     except KeyboardInterrupt:
         logging.warning(
             "Ctrl + C User interrupt. Shutting down gracefully...")
@@ -0,0 +1,65 @@
+import logging
+from app.defaults import PAGE_SIZE
+from app.paging import iter_listing
+
+ARTIST_TYPE = 8
+ALBUM_TYPE = 9
+
+
+def build_count_index(plex, section, page_size=PAGE_SIZE):
+    # Maps each artist ratingKey to (albums, tracks) using the album listing
+    # of the section, which carries parentRatingKey and leafCount, so the
+    # whole section costs one request per page instead of one per album.
+    if section.type != 'artist':
+        return None
+    index = {}
+    for album in iter_listing(plex, section, ALBUM_TYPE, page_size):
+        parent_key = album.attrib.get('parentRatingKey')
+        leaf_count = album.attrib.get('leafCount')
+        if parent_key is None or leaf_count is None:
+            logging.debug(
+                f"Album listing missing counts for {section.title}, falling back to per-artist queries")
+            return None
+        album_count, track_count = index.get(int(parent_key), (0, 0))
+        index[int(parent_key)] = (
+            album_count + 1, track_count + int(leaf_count))
+    return index
+
+
+def build_album_index(plex, section, page_size=PAGE_SIZE):
+    # Maps album ratingKey -> (title, year) for joining onto tracks.
+    index = {}
+    for album in iter_listing(plex, section, ALBUM_TYPE, page_size):
+        year = album.attrib.get('year')
+        index[int(album.attrib['ratingKey'])] = (
+            album.attrib.get('title'), int(year) if year else None)
+    return index
+
+
+def build_artist_index(plex, section, page_size=PAGE_SIZE):
+    # Maps artist ratingKey -> (title, genres) for joining onto tracks.
+    index = {}
+    for artist in iter_listing(plex, section, ARTIST_TYPE, page_size):
+        genres = ', '.join(genre.attrib['tag']
+                           for genre in artist.iter('Genre')) or None
+        index[int(artist.attrib['ratingKey'])] = (
+            artist.attrib.get('title'), genres)
+    return index
+
+
+def listing_counts(item):
+    # (childCount, leafCount) as the listing reports them, or None for items
+    # without either, like movies and tracks.
+    data = getattr(item, '_data', None)
+    if data is None:
+        return None
+    counts = tuple(int(value) if value else None
+                   for value in (data.attrib.get('childCount'), data.attrib.get('leafCount')))
+    return counts if any(value is not None for value in counts) else None
+
+
+def show_counts(show):
+    # The section listing already includes childCount/leafCount for shows.
+    if show.childCount is None or show.leafCount is None:
+        return None
+    return show.childCount, show.leafCount
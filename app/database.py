@@ -0,0 +1,226 @@
+import logging
+import sqlite3
+from app.counts import listing_counts
+
+BATCH_SIZE = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    rating_key INTEGER PRIMARY KEY,
+    section_id INTEGER NOT NULL,
+    section_title TEXT,
+    type TEXT,
+    guid TEXT,
+    title TEXT,
+    year INTEGER,
+    rating REAL,
+    summary TEXT,
+    duration INTEGER,
+    child_count INTEGER,
+    leaf_count INTEGER,
+    added_at INTEGER,
+    updated_at INTEGER
+);
+CREATE TABLE IF NOT EXISTS genres (
+    rating_key INTEGER NOT NULL REFERENCES items(rating_key) ON DELETE CASCADE,
+    tag TEXT NOT NULL,
+    PRIMARY KEY (rating_key, tag)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS people (
+    rating_key INTEGER NOT NULL REFERENCES items(rating_key) ON DELETE CASCADE,
+    role TEXT NOT NULL,
+    tag TEXT NOT NULL,
+    PRIMARY KEY (rating_key, role, tag)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS parts (
+    part_id INTEGER PRIMARY KEY,
+    rating_key INTEGER NOT NULL REFERENCES items(rating_key) ON DELETE CASCADE,
+    media_id INTEGER,
+    file TEXT,
+    size INTEGER,
+    container TEXT,
+    video_codec TEXT,
+    video_resolution TEXT,
+    bitrate INTEGER,
+    audio_channels INTEGER,
+    duration INTEGER
+);
+CREATE TABLE IF NOT EXISTS external_ids (
+    rating_key INTEGER NOT NULL REFERENCES items(rating_key) ON DELETE CASCADE,
+    source TEXT NOT NULL,
+    id TEXT NOT NULL,
+    PRIMARY KEY (rating_key, source)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS items_section ON items(section_id);
+CREATE INDEX IF NOT EXISTS items_guid ON items(guid);
+CREATE INDEX IF NOT EXISTS items_title_year ON items(title, year);
+CREATE INDEX IF NOT EXISTS items_added_at ON items(added_at);
+CREATE INDEX IF NOT EXISTS parts_rating_key ON parts(rating_key);
+CREATE INDEX IF NOT EXISTS external_ids_source_id ON external_ids(source, id);
+"""
+
+UPSERT_ITEM = """
+INSERT INTO items (rating_key, section_id, section_title, type, guid, title, year, rating, summary,
+                   duration, child_count, leaf_count, added_at, updated_at)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(rating_key) DO UPDATE SET
+    section_id = excluded.section_id,
+    section_title = excluded.section_title,
+    type = excluded.type,
+    guid = excluded.guid,
+    title = excluded.title,
+    year = excluded.year,
+    rating = excluded.rating,
+    summary = excluded.summary,
+    duration = excluded.duration,
+    child_count = excluded.child_count,
+    leaf_count = excluded.leaf_count,
+    added_at = excluded.added_at,
+    updated_at = excluded.updated_at
+"""
+
+UPSERT_PART = """
+INSERT INTO parts (part_id, rating_key, media_id, file, size, container, video_codec,
+                   video_resolution, bitrate, audio_channels, duration)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(part_id) DO UPDATE SET
+    rating_key = excluded.rating_key,
+    media_id = excluded.media_id,
+    file = excluded.file,
+    size = excluded.size,
+    container = excluded.container,
+    video_codec = excluded.video_codec,
+    video_resolution = excluded.video_resolution,
+    bitrate = excluded.bitrate,
+    audio_channels = excluded.audio_channels,
+    duration = excluded.duration
+"""
+
+
+def epoch(value):
+    return int(value.timestamp()) if value else None
+
+
+def item_record(section, item, child_count=None, leaf_count=None, ids=None):
+    # Returns the rows one library item contributes to each table.
+    rating_key = item.ratingKey
+    record = {
+        'item': (rating_key, section.key, section.title, item.type, item.guid, item.title, getattr(item, 'year', None),
+                 getattr(item, 'rating', None), item.summary, getattr(item, 'duration', None),
+                 child_count, leaf_count, epoch(item.addedAt), epoch(item.updatedAt)),
+        'genres': [(rating_key, genre.tag) for genre in item.genres],
+        'people': [],
+        'parts': [],
+        'external_ids': [(rating_key, source, id) for source, id in (ids or {}).items()],
+    }
+    for role, attribute in (('director', 'directors'), ('writer', 'writers'), ('actor', 'actors')):
+        record['people'].extend((rating_key, role, person.tag)
+                                for person in getattr(item, attribute, None) or [])
+    for media in getattr(item, 'media', None) or []:
+        for part in media.parts:
+            record['parts'].append((part.id, rating_key, media.id, part.file, part.size, media.container,
+                                    media.videoCodec, media.videoResolution, media.bitrate,
+                                    media.audioChannels, part.duration))
+    return record
+
+
+class SqliteExport:
+    # Upserts one section into a shared database in batched transactions and
+    # removes items of the section that are no longer on the server. Music
+    # sections hold artists and tracks, so item_type limits both to the
+    # type being exported.
+    def __init__(self, filename, section, item_type=None, batch_size=BATCH_SIZE,
+                 check_same_thread=True) -> None:
+        self.conn = sqlite3.connect(filename, check_same_thread=check_same_thread)
+        self.conn.execute("PRAGMA foreign_keys = ON")
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.executescript(SCHEMA)
+        self.section = section
+        self.batch_size = batch_size
+        self.batch = []
+        self.seen = set()
+        self.skipped = 0
+        self.updated_at = {}
+        self.counts = {}
+        query = "SELECT rating_key, updated_at, child_count, leaf_count FROM items WHERE section_id = ?"
+        parameters = (section.key,)
+        if item_type is not None:
+            query += " AND type = ?"
+            parameters += (item_type,)
+        for rating_key, updated_at, child_count, leaf_count in self.conn.execute(query, parameters):
+            self.updated_at[rating_key] = updated_at
+            self.counts[rating_key] = (child_count, leaf_count)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close(delete_missing=exc_type is None)
+
+    def close(self, delete_missing=True):
+        try:
+            self.flush()
+            if delete_missing:
+                self.delete_missing()
+        finally:
+            self.conn.close()
+
+    def is_current(self, item, counts=None):
+        # New or removed episodes and tracks don't always change updatedAt,
+        # so the child counts must match too: the listing's unless counts
+        # are given.
+        updated_at = epoch(item.updatedAt)
+        if updated_at is None or self.updated_at.get(item.ratingKey) != updated_at:
+            return False
+        counts = listing_counts(item) if counts is None else counts
+        stored = self.counts.get(item.ratingKey, (None, None))
+        return counts is None or all(value is None or value == previous
+                                     for value, previous in zip(counts, stored))
+
+    def write(self, item, record):
+        self.seen.add(item.ratingKey)
+        if record is None:
+            self.skipped += 1
+            return
+        self.batch.append(record)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.batch:
+            return
+        keys = [(record['item'][0],) for record in self.batch]
+        with self.conn:
+            self.conn.executemany(
+                UPSERT_ITEM, [record['item'] for record in self.batch])
+            self.conn.executemany(
+                "DELETE FROM genres WHERE rating_key = ?", keys)
+            self.conn.executemany(
+                "DELETE FROM people WHERE rating_key = ?", keys)
+            self.conn.executemany(
+                "DELETE FROM parts WHERE rating_key = ?", keys)
+            self.conn.executemany(
+                "DELETE FROM external_ids WHERE rating_key = ?", keys)
+            self.conn.executemany("INSERT OR IGNORE INTO genres VALUES (?, ?)",
+                                  [row for record in self.batch for row in record['genres']])
+            self.conn.executemany("INSERT OR IGNORE INTO people VALUES (?, ?, ?)",
+                                  [row for record in self.batch for row in record['people']])
+            self.conn.executemany(UPSERT_PART,
+                                  [row for record in self.batch for row in record['parts']])
+            self.conn.executemany("INSERT OR IGNORE INTO external_ids VALUES (?, ?, ?)",
+                                  [row for record in self.batch for row in record['external_ids']])
+        self.batch = []
+
+    def delete(self, rating_keys):
+        with self.conn:
+            self.conn.executemany(
+                "DELETE FROM items WHERE rating_key = ?", [(key,) for key in rating_keys])
+
+    def delete_missing(self):
+        missing = [(key,) for key in self.updated_at if key not in self.seen]
+        with self.conn:
+            self.conn.executemany(
+                "DELETE FROM items WHERE rating_key = ?", missing)
+        logging.info(
+            f"SQLite export of {self.section.title}: {len(self.seen) - self.skipped} upserted, "
+            f"{self.skipped} unchanged, {len(missing)} deleted")
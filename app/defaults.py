@@ -0,0 +1,15 @@
+# Defaults and choices shared by the command line and the modules that use
+# them. Nothing is imported here, so app.cli can read them without loading
+# plexapi, openpyxl or the export pipeline.
+CACHE_SIZE_MB = 256
+PAGE_SIZE = 500
+CONCURRENCY = 64
+ROW_FORMATS = ['csv', 'xlsx', 'jsonl', 'snapshot']
+FORMATS = ROW_FORMATS + ['sqlite']
+DEBOUNCE = 5.0
+POLL_INTERVAL = 60.0
+TIMEOUT = 30
+RETRIES = 3
+STATS_FORMATS = ['json', 'csv']
+TOP = 20
+COMPRESSIONS = ['none', 'gzip', 'bz2', 'xz', 'zstd']
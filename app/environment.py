@@ -1,17 +1,44 @@
-import subprocess
+import hashlib
 import sys
-import pkg_resources
 import os
 
+REQUIRED_PACKAGES = ['plexapi', 'coloredlogs', 'python-dotenv', 'openpyxl', 'numpy']
+DEPENDENCY_MARKER = os.path.join(
+    os.path.expanduser("~"), ".cache", "plexport", "dependencies-ok")
+
+
+def dependency_key():
+    # The check is redone whenever the interpreter or requirements change.
+    key = f"{sys.executable}|{sys.version}|{','.join(REQUIRED_PACKAGES)}"
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
 
 def install_missing_packages():
-    required_packages = {'plexapi', 'coloredlogs'}
-    installed_packages = {pkg.key for pkg in pkg_resources.working_set}
-    missing_packages = required_packages - installed_packages
+    key = dependency_key()
+    try:
+        with open(DEPENDENCY_MARKER) as f:
+            if f.read().strip() == key:
+                return
+    except OSError:
+        pass
+    from importlib import metadata
+    missing_packages = []
+    for package in REQUIRED_PACKAGES:
+        try:
+            metadata.distribution(package)
+        except metadata.PackageNotFoundError:
+            missing_packages.append(package)
     if missing_packages:
+        import subprocess
         python = sys.executable
         subprocess.check_call(
             [python, '-m', 'pip', 'install', '--user', '-r', 'requirements.txt'])
+    try:
+        os.makedirs(os.path.dirname(DEPENDENCY_MARKER), exist_ok=True)
+        with open(DEPENDENCY_MARKER, 'w') as f:
+            f.write(key)
+    except OSError:
+        pass
 
 
 def set_environment(args):
@@ -50,6 +77,13 @@ def set_environment(args):
     else:
         os.environ['LOG_LEVEL'] = "info"
 
+    if args.log_queue:
+        os.environ['LOG_QUEUE'] = args.log_queue
+    elif os.environ.get("LOG_QUEUE"):
+        os.environ['LOG_QUEUE'] = os.environ.get("LOG_QUEUE")
+    else:
+        os.environ['LOG_QUEUE'] = "false"
+
     if args.sections:
         os.environ['SECTIONS'] = args.sections
     elif os.environ.get("SECTIONS"):
@@ -63,4 +97,5 @@ def set_environment(args):
         f.write(f"EXPORT_DIR={os.environ.get('EXPORT_DIR')}\n")
         f.write(f"LOG_DIR={os.environ.get('LOG_DIR')}\n")
         f.write(f"LOG_LEVEL={os.environ.get('LOG_LEVEL')}\n")
+        f.write(f"LOG_QUEUE={os.environ.get('LOG_QUEUE')}\n")
         f.write(f"SECTIONS={os.environ.get('SECTIONS')}\n")
@@ -1,183 +1,535 @@
 import os
-import csv
+import itertools
 import logging
-from app.agent import generate_link
-from openpyxl import Workbook
+import time
+from app.agent import resolve_ids
+from app.checkpoint import Checkpoint, partial_filename
+from app.columns import compile_row, required_fields, select_columns
+from app.counts import build_album_index, build_artist_index, build_count_index, show_counts
+from app.database import item_record
+from app.defaults import FORMATS, PAGE_SIZE, ROW_FORMATS
+from app.filters import SectionFilter, filter_label
+from app.match import MatchItem
+from app.metrics import metrics
+from app.paging import iter_section, total_size
+from app.pool import map_ordered
+from app.progress import Progress
+from app.shards import SHARDED_FORMATS, manifest_filename, resumable
+from app.sinks import CsvSink, JsonlSink, Mark, SnapshotSink, SqliteSink, XlsxSink
+from app.state import SectionState, item_version, read_rows
+
+SINKS = {'csv': CsvSink, 'xlsx': XlsxSink, 'jsonl': JsonlSink, 'snapshot': SnapshotSink, 'sqlite': SqliteSink}
+
+
+def describe_movie(movie):
+    return f"Movie Exported: {movie.title} ({movie.year})"
+
+
+def describe_tvshow(show):
+    return f"TV Show Exported: {show.title} ({show.year})"
+
+
+def describe_artist(artist):
+    return f"Music Artist Exported: {artist.title}"
+
+
+def describe_track(track):
+    return f"Music Track Exported: {track.grandparentTitle} - {track.title}"
 
 
 class Export:
-    def __init__(self, plex, export_dir) -> None:
+    def __init__(self, plex, export_dir, workers=4, bulk_counts=True, page_size=PAGE_SIZE,
+                 incremental=False, cache=None, columns=None, engine=None, name=None, match=False,
+                 music='artists', resume=False, filters=None, output=None, stop=None) -> None:
         self.plex = plex
+        self.name = name
         self.export_dir = export_dir
+        self.workers = workers
+        self.bulk_counts = bulk_counts
+        self.page_size = page_size
+        self.incremental = incremental
+        self.cache = cache
+        self.column_names = columns
+        self.engine = engine
+        self.music = music
+        self.resume = resume
+        # Option name -> value of the --added-since, --year, ... filters.
+        self.filters = filters or {}
+        self.filter = None
+        # Compression and shard sizes of the csv and jsonl outputs (see
+        # app.shards), or None for plain files.
+        self.output = output
+        self.columns = []
+        self.fields = frozenset()
+        self.build_row = None
+        self.counts = None
+        self.child_counts = {}
+        self.albums = None
+        self.artists = None
+        self.ids = {}
+        # Title, year and external ids of every exported item for app.match.
+        self.match_items = [] if match else None
+        self.states = {}
+        self.checkpoint = None
+        self.resumed = None
+        self.mark = None
+        self.positions = {}
+        self.section = None
+        self.progress = None
+        self.interrupted = False
+        # Set from another thread to interrupt the export like Ctrl + C,
+        # which only reaches the main thread.
+        self.stop = stop
 
-    def export(self, format="csv"):
-        if format not in ["csv", "xlsx"]:
-            raise ValueError("Unsupported format. Choose 'csv' or 'xlsx'.")
-
+    def sections(self):
+        # Library sections selected by SECTIONS that can be exported.
         SECTIONS = os.environ.get("SECTIONS", "all_sections").split(",")
+        return [section for section in self.plex.library.sections()
+                if ("all_sections" in SECTIONS or section.title in SECTIONS)
+                and section.type in ('movie', 'show', 'artist')]
+
+    def get_filename(self, section_title, format):
+        if format == "sqlite":
+            # Every section shares one database so exports can be joined.
+            return os.path.join(self.export_dir, "plexport.sqlite")
+        return os.path.join(self.export_dir, f"{section_title}.{format}")
 
-        def is_section_valid(section_title):
-            return "all_sections" in SECTIONS or section_title in SECTIONS
+    def sharded(self, format):
+        return self.output is not None and format in SHARDED_FORMATS
 
-        def get_filename(section_title):
-            return os.path.join(self.export_dir, f"{section_title}.{format}")
+    def get_output_filename(self, filename, format):
+        # The file later runs read the previous rows from: the manifest of
+        # sharded outputs.
+        return manifest_filename(filename) if self.sharded(format) else filename
+
+    def open_sink(self, format, filename, resumed=None):
+        # The sink of a row format, sharded when the output asks for it.
+        if self.sharded(format):
+            return SINKS[format](filename, self.headers(), resumed, output=self.output)
+        return SINKS[format](filename, self.headers(), resumed)
+
+    def get_state_filename(self, section_title, format):
+        return os.path.join(self.export_dir, ".state", f"{section_title}.{format}.json")
+
+    def get_checkpoint_filename(self, section_title):
+        return os.path.join(self.export_dir, ".state", f"{section_title}.checkpoint.json")
+
+    def configure_section(self, section, formats):
+        # Selects the columns and fields exported for a section. Returns the
+        # item type, output title and row formats, or None when no selected
+        # column or format applies to the section.
+        # Music sections export one row per artist, or with --music tracks
+        # one row per track. Filtered exports get outputs of their own.
+        item_type = 'track' if section.type == 'artist' and self.music == 'tracks' else section.type
+        output_title = f"{section.title} Tracks" if item_type == 'track' else section.title
+        if self.filters:
+            output_title = f"{output_title} ({filter_label(self.filters)})"
+        self.section = section
+        self.columns = select_columns(item_type, self.column_names)
+        row_formats = [
+            format for format in formats if format in ROW_FORMATS] if self.columns else []
+        if not row_formats and "sqlite" not in formats:
+            logging.info(
+                f"No selected columns apply to {section.title}, skipping")
+            return None
+        self.fields = required_fields(
+            self.columns) if row_formats else frozenset()
+        # SQLite records have a fixed schema and need every field.
+        if "sqlite" in formats:
+            self.fields |= {
+                'ids'} if item_type == 'track' else {'ids', 'counts'}
+        if self.match_items is not None and item_type != 'track':
+            self.fields |= {'ids'}
+        self.build_row = compile_row(self.columns)
+        return item_type, output_title, row_formats
+
+    def export(self, formats=("csv",), sections=None):
+        # Every format of a section is written from a single pass over the
+        # server: items are fetched and built once, then fanned out to one
+        # sink per format. sections limits the export to these section keys.
+        if isinstance(formats, str):
+            formats = [formats]
+        if not formats or any(format not in FORMATS for format in formats):
+            raise ValueError(
+                f"Unsupported format. Choose from {', '.join(FORMATS)}.")
 
         handlers = {
-            'movie': (getattr(self, f'write_movies_to_{format}'), f"Processing library section: {{section.title}}"),
-            'show': (getattr(self, f'write_tvshows_to_{format}'), f"Processing library section: {{section.title}}"),
-            'artist': (getattr(self, f'write_music_to_{format}'), f"Processing library section: {{section.title}}")
+            'movie': (describe_movie, f"Processing library section: {{section.title}}"),
+            'show': (describe_tvshow, f"Processing library section: {{section.title}}"),
+            'artist': (describe_artist, f"Processing library section: {{section.title}}"),
+            'track': (describe_track, f"Processing tracks of library section: {{section.title}}")
         }
 
         try:
-            for section in self.plex.library.sections():
-                if is_section_valid(section.title) and section.type in handlers:
-                    logging.info(handlers[section.type]
+            for section in self.sections():
+                if sections is None or section.key in sections:
+                    item_type = 'track' if section.type == 'artist' and self.music == 'tracks' else section.type
+                    logging.info(handlers[item_type]
                                  [1].format(section=section))
-                    items = section.all()
-                    filename = get_filename(section.title)
-                    handlers[section.type][0](items, filename)
+                    configured = self.configure_section(section, formats)
+                    if configured is None:
+                        continue
+                    item_type, output_title, row_formats = configured
+                    libtype = 'track' if item_type == 'track' else None
+                    self.filter = SectionFilter.plan(
+                        section, item_type, libtype, self.filters) if self.filters else None
+                    if self.filters and self.filter is None:
+                        continue
+                    label = f"{self.name}/{section.title}" if self.name else section.title
+                    metrics.start_section(label)
+                    self.counts = build_count_index(
+                        self.plex, section, self.page_size) if self.bulk_counts and 'counts' in self.fields else None
+                    self.child_counts = {}
+                    # Tracks are joined with albums and artists from one
+                    # listing each instead of crawling artist -> album.
+                    self.albums = build_album_index(
+                        self.plex, section, self.page_size) if 'album' in self.fields else None
+                    self.artists = build_artist_index(
+                        self.plex, section, self.page_size) if 'artist' in self.fields else None
+                    self.progress = Progress(label, total_size(self.plex, self.listing_key(section, libtype))
+                                             if self.filter else
+                                             section.totalViewSize(libtype=libtype, includeCollections=False))
+                    filenames = {format: self.get_filename(output_title, format)
+                                 for format in row_formats}
+                    if self.incremental:
+                        self.states = {format: SectionState.load(self.get_state_filename(output_title, format),
+                                                                 self.get_output_filename(filenames[format], format),
+                                                                 format, self.headers())
+                                       for format in row_formats}
+                    # SQLite upserts are committed in batches, so a rerun
+                    # already skips whatever the interrupted run stored.
+                    self.checkpoint = Checkpoint(self.get_checkpoint_filename(
+                        output_title), self.headers(), row_formats, self.filters) if row_formats else None
+                    self.resumed = self.load_checkpoint(
+                        filenames) if self.resume and self.checkpoint else None
+                    items = self.section_items(section, libtype)
+                    for state in self.states.values():
+                        state.open_journal(
+                            self.resumed['rows'] if self.resumed else 0)
+                    sinks = [self.open_sink(format, filenames[format], self.resumed)
+                             for format in row_formats]
+                    if "sqlite" in formats:
+                        # Items outside the listing only count as deleted
+                        # when the whole section was listed.
+                        sinks.append(SqliteSink(self.get_filename(output_title, "sqlite"), self.headers(), self.resumed,
+                                                section=section, item_type=item_type,
+                                                delete_missing=not self.resumed and not self.filter))
+                    self.write_section(items, sinks, handlers[item_type][0])
+                    for format, state in self.states.items():
+                        state.save()
+                        logging.info(
+                            f"Incremental {format} export of {label}: {state.summary()}")
+                    self.states = {}
+                    self.progress.finish()
+                    metrics.end_section()
+                    self.checkpoint = None
         except KeyboardInterrupt:
+            self.interrupted = True
             logging.warning(
                 f"Ctrl + C User interrupt. Shutting down gracefully...")
+            if self.checkpoint:
+                logging.warning(
+                    "Run the export again with --resume to continue from the last checkpoint.")
         # except Exception as e:
         #     logging.warning(f"Failed to export to {format.upper()}: {e}")
 
-    def write_movies_to_csv(self, movies, filename):
-        with open(filename, mode='w', newline='', encoding='utf-8') as file:
-            writer = csv.writer(file)
-            headers = ['Name', 'Year', 'Link', 'Rating', 'Summary', 'Duration (mins)', 'Genres', 'Directors', 'Writers',
-                       'Actors', 'Resolution', 'Codec', 'Container', 'Bitrate', 'Size (MiB)', 'Audio Channels', 'Added At', 'Updated At']
-            writer.writerow(headers)
-            for movie in movies:
-                movie_data = self.write_movie(movie)
-                writer.writerow(self.values_in_order(movie_data))
-                logging.info(
-                    f"Movie Exported: {movie_data.get('Name')} ({movie_data.get('Year')})")
-
-    def write_tvshows_to_csv(self, shows, filename):
-        with open(filename, mode='w', newline='', encoding='utf-8') as file:
-            writer = csv.writer(file)
-            headers = ['Name', 'Year', 'Link', 'Rating', 'Summary', 'Genres',
-                       'Total Seasons', 'Total Episodes', 'Added At', 'Updated At']
-            writer.writerow(headers)
-            for show in shows:
-                link = generate_link(show)
-                genres = ', '.join(
-                    [genre.tag for genre in show.genres]) if show.genres else None
-                added_at = show.addedAt.strftime(
-                    '%Y-%m-%d %H:%M:%S') if show.addedAt else None
-                updated_at = show.updatedAt.strftime(
-                    '%Y-%m-%d %H:%M:%S') if show.updatedAt else None
-                writer.writerow([show.title, show.year, link, show.rating, show.summary, genres, len(
-                    show.seasons()), len(show.episodes()), added_at, updated_at])
-                logging.info(f"TV Show Exported: {show.title} ({show.year})")
-
-    def write_music_to_csv(self, artists, filename):
-        with open(filename, mode='w', newline='', encoding='utf-8') as file:
-            writer = csv.writer(file)
-            headers = ['Artist Name', 'Genres', 'Albums',
-                       'Tracks', 'Added At', 'Updated At']
-            writer.writerow(headers)
-            for artist in artists:
-                genres = ', '.join(
-                    [genre.tag for genre in artist.genres]) if artist.genres else None
-                added_at = artist.addedAt.strftime(
-                    '%Y-%m-%d %H:%M:%S') if artist.addedAt else None
-                updated_at = artist.updatedAt.strftime(
-                    '%Y-%m-%d %H:%M:%S') if artist.updatedAt else None
-                albums = len(artist.albums())
-                tracks = sum(len(album.tracks()) for album in artist.albums())
-                writer.writerow([artist.title, genres, albums,
-                                 tracks, added_at, updated_at])
-                logging.info(f"Music Artist Exported: {artist.title}")
-
-    def write_movies_to_xlsx(self, movies, filename):
-        wb = Workbook()
-        ws = wb.active
-        headers = ['Name', 'Year', 'Link', 'Rating', 'Summary', 'Duration (mins)', 'Genres', 'Directors', 'Writers',
-                   'Actors', 'Resolution', 'Codec', 'Container', 'Bitrate', 'Size (MiB)', 'Audio Channels', 'Added At', 'Updated At']
-        ws.append(headers)
-        for movie in movies:
-            movie_data = self.write_movie(movie)
-            ws.append(self.values_in_order(movie_data))
+    def listing_key(self, section, libtype):
+        return self.filter.key(section, libtype, 'ids' in self.fields) if self.filter else None
+
+    def open_items(self, section, libtype, start=0):
+        key = self.listing_key(section, libtype)
+        if self.engine is not None:
+            items = self.engine.iter_section(section, self.page_size, include_guids='ids' in self.fields,
+                                             lookups=self.child_lookups, counted=self.counted,
+                                             libtype=libtype, start=start, key=key)
+        else:
+            items = iter_section(section, self.page_size, libtype=libtype, start=start, key=key,
+                                 includeGuids='ids' in self.fields)
+        return self.prepare_items(items)
+
+    def load_checkpoint(self, filenames):
+        resumed = self.checkpoint.load()
+        if not resumed or resumed['rows'] <= 0:
+            return None
+        for format, filename in filenames.items():
+            partial = partial_filename(filename)
+            if self.sharded(format):
+                if not resumable(filename, self.output, resumed['positions'][format]):
+                    return None
+                continue
+            if not os.path.exists(partial) or isinstance(resumed['positions'][format], dict):
+                return None
+            if format in ("xlsx", "snapshot"):
+                # Partial workbooks and snapshots are saved when the export
+                # stops, so they may hold rows past the checkpoint; those are
+                # dropped.
+                rows = read_rows(partial, format)
+                if len(rows) - 1 < resumed['rows']:
+                    logging.warning(
+                        f"{partial} doesn't match its checkpoint, starting over")
+                    return None
+                resumed['previous_rows'] = rows[1:resumed['rows'] + 1]
+            elif os.path.getsize(partial) < resumed['positions'][format]:
+                return None
+        return resumed
+
+    def section_items(self, section, libtype):
+        # Resumes the listing at the checkpoint, after checking that the item
+        # before it is still the last one written. Matching needs every item
+        # and rows don't map to listing offsets when items are filtered on
+        # this side, so both re-read the listing from the start instead.
+        resumed = self.resumed
+        if resumed is None:
+            return self.open_items(section, libtype)
+        rows = resumed['rows']
+        start = 0 if self.match_items is not None or self.filter and self.filter.checks else rows - 1
+        matched = len(self.match_items) if self.match_items is not None else 0
+        items = self.open_items(section, libtype, start)
+        last = None
+        for last in itertools.islice(items, rows - start):
+            pass
+        if last is not None and last.ratingKey == resumed['rating_key']:
             logging.info(
-                f"Movie Exported: {movie_data.get('title')} ({movie_data.get('year')})")
-        wb.save(filename)
-
-    def write_tvshows_to_xlsx(self, shows, filename):
-        wb = Workbook()
-        ws = wb.active
-        headers = ['Name', 'Year', 'Link', 'Rating', 'Summary', 'Genres',
-                   'Total Seasons', 'Total Episodes', 'Added At', 'Updated At']
-        ws.append(headers)
-        for show in shows:
-            link = generate_link(show)
-            genres = ', '.join([genre.tag for genre in show.genres])
-            added_at = show.addedAt.strftime("%Y-%m-%d %H:%M:%S")
-            updated_at = show.updatedAt.strftime("%Y-%m-%d %H:%M:%S")
-            ws.append([show.title, show.year, link, show.rating, show.summary, genres, len(
-                show.seasons()), len(show.episodes()), added_at, updated_at])
-            logging.info(f"TV Show Exported: {show.title} ({show.year})")
-
-    def write_music_to_xlsx(self, artists, filename):
-        wb = Workbook()
-        ws = wb.active
-        headers = ['Artist Name', 'Genres', 'Albums',
-                   'Tracks', 'Added At', 'Updated At']
-        ws.append(headers)
-        for artist in artists:
-            genres = ', '.join([genre.tag for genre in artist.genres])
-            albums = len(artist.albums())
-            tracks = sum([len(album.tracks()) for album in artist.albums()])
-            added_at = artist.addedAt.strftime("%Y-%m-%d %H:%M:%S")
-            updated_at = artist.updatedAt.strftime("%Y-%m-%d %H:%M:%S")
-            ws.append([artist.title, genres, albums,
-                      tracks, added_at, updated_at])
-            logging.info(f"Music Artist Exported: {artist.title}")
-
-    def values_in_order(self, data):
-        # This function assumes data is a dict containing movie details.
-        # We can use it to order our data correctly for CSV and Excel rows.
-        return [data.get(header) for header in ['Name', 'Year', 'Link', 'Rating', 'Summary', 'Duration (mins)', 'Genres', 'Directors', 'Writers',
-                                                'Actors', 'Resolution', 'Codec', 'Container', 'Bitrate', 'Size (MiB)', 'Audio Channels', 'Added At', 'Updated At']]
-
-    def write_movie(self, movie):
-        # This function returns a dictionary of movie details.
-        link = generate_link(movie)
-        genres = ', '.join([genre.tag for genre in movie.genres])
-        directors = ', '.join([director.tag for director in movie.directors])
-        writers = ', '.join([writer.tag for writer in movie.writers])
-        actors = ', '.join([actor.tag for actor in movie.actors])
-        resolution = movie.media[0].videoResolution
-        codec = movie.media[0].videoCodec
-        container = movie.media[0].container
-        bitrate = movie.media[0].bitrate
-        size_mb = movie.media[0].parts[0].size / (1024 ** 2)
-        audio_channels = movie.media[0].audioChannels
-        added_at = movie.addedAt.strftime("%Y-%m-%d %H:%M:%S")
+                f"Resuming export of {section.title} after {rows} rows")
+            self.progress.count = rows
+            return items
+        items.close()
+        logging.warning(
+            f"{section.title} changed since the checkpoint, starting over")
+        if self.match_items is not None:
+            del self.match_items[matched:]
+        self.resumed = None
+        return self.open_items(section, libtype)
+
+    def marked(self, format, mark, position):
+        # Called by each row sink once it has written the rows before mark.
+        if mark is self.mark:
+            self.positions[format] = position
+
+    def update_checkpoint(self, sinks, count, rating_key):
+        # Marks are sent to the row sinks every CHECKPOINT_ROWS rows or
+        # CHECKPOINT_INTERVAL seconds; the checkpoint is saved once every
+        # sink has reached the mark.
+        if self.mark is None:
+            if self.checkpoint.due():
+                self.mark = Mark(count, rating_key)
+                self.positions = {}
+                for sink in sinks:
+                    sink.put(self.mark)
+        elif len(self.positions) == len(sinks):
+            self.save_checkpoint()
+
+    def save_checkpoint(self):
+        for state in self.states.values():
+            state.flush_journal()
+        self.checkpoint.save(self.mark.rows, self.mark.rating_key, self.positions)
+        self.mark = None
+
+    def prepare_items(self, items):
+        # Missing attributes on partial listing items stay missing instead of
+        # reloading the item; only columns that need the full item reload it.
+        # External ids come with the listing and are indexed by ratingKey.
+        self.ids = {}
+        for item in items:
+            item._autoReload = False
+            if self.filter and not self.filter.matches(item):
+                continue
+            if 'ids' in self.fields:
+                self.ids[item.ratingKey] = resolve_ids(item)
+            if self.match_items is not None and item.type != 'track':
+                self.match_items.append(MatchItem(self.name or self.plex.friendlyName, self.section.title, item.type, item.ratingKey,
+                                                  item.title, getattr(item, 'year', None), self.ids[item.ratingKey]))
+            yield item
+
+    def headers(self):
+        return [column.header for column in self.columns]
+
+    def write_section(self, items, sinks, describe):
+        # Rows and records are built on worker threads and handed to every
+        # sink in listing order.
+        row_sinks = [sink for sink in sinks if sink.format != "sqlite"]
+        db = next((sink for sink in sinks if sink.format == "sqlite"), None)
+        count = self.resumed['rows'] if self.resumed else 0
+
+        def build(item):
+            started = time.perf_counter()
+            rows = self.cached_rows(item) if row_sinks else None
+            build_row = row_sinks and rows is None
+            build_record = db is not None and not self.is_current(db, item)
+            row = record = None
+            if build_row or build_record:
+                data = self.item_data(item)
+                with metrics.phase('build'):
+                    if build_row:
+                        row = self.build_row(item, data)
+                    if build_record:
+                        record = item_record(self.section, item, *data.get('counts', (None, None)),
+                                             ids=data.get('ids'))
+            else:
+                self.ids.pop(item.ratingKey, None)
+            return rows, row, record, time.perf_counter() - started
+
+        self.mark = None
+        for sink in sinks:
+            sink.start(self.marked)
+        completed = False
         try:
-            updated_at = movie.updatedAt.strftime("%Y-%m-%d %H:%M:%S")
-        except AttributeError as e:
-            updated_at = None
-        duration_mins = movie.duration // 60000  # Convert from ms to mins
-
-        return {
-            'Name': movie.title,
-            'Year': movie.year,
-            'Link': link,
-            'Rating': movie.rating,
-            'Summary': movie.summary,
-            'Duration (mins)': duration_mins,
-            'Genres': genres,
-            'Directors': directors,
-            'Writers': writers,
-            'Actors': actors,
-            'Resolution': resolution,
-            'Codec': codec,
-            'Container': container,
-            'Bitrate': bitrate,
-            'Size (MiB)': round(size_mb, 2),
-            'Audio Channels': audio_channels,
-            'Added At': added_at,
-            'Updated At': updated_at
-        }
+            for item, (rows, row, record, seconds) in map_ordered(build, items, self.workers):
+                if self.stop is not None and self.stop.is_set():
+                    raise KeyboardInterrupt
+                # Unchanged items reuse each output's previous row, which
+                # keeps the value types that output read back.
+                version = self.item_version(item) if self.states else None
+                for format, state in self.states.items():
+                    state.record(item, rows[format] if rows else row, version)
+                metrics.item(item.title, seconds)
+                for sink in sinks:
+                    sink.put((item, rows.get(sink.format) if rows else row, record))
+                count += 1
+                if self.checkpoint:
+                    self.update_checkpoint(row_sinks, count, item.ratingKey)
+                self.log_item(describe, item)
+            completed = True
+        finally:
+            for sink in sinks:
+                sink.finish(completed)
+            if self.checkpoint:
+                if completed:
+                    self.checkpoint.clear()
+                elif self.mark is not None and len(self.positions) == len(row_sinks):
+                    self.save_checkpoint()
+
+    def cached_rows(self, item):
+        # The previous rows of an unchanged item per format, or None unless
+        # every output has one.
+        if not self.states:
+            return None
+        version = self.item_version(item)
+        rows = {}
+        for format, state in self.states.items():
+            row = state.cached_row(item, version)
+            if row is None:
+                return None
+            rows[format] = row
+        return rows
+
+    def artist_counts(self, item):
+        # An artist's listing has no child counts; the bulk count index
+        # stands in for them.
+        if item.type == 'artist' and self.counts is not None:
+            return self.counts.get(item.ratingKey, (0, 0))
+        return None
+
+    def item_version(self, item):
+        # Artist counts fetched per artist can't be checked before fetching
+        # them, so without bulk counts those rows are rebuilt every run.
+        if item.type == 'artist' and self.counts is None and 'counts' in self.fields:
+            return None
+        return item_version(item, self.artist_counts(item))
+
+    def is_current(self, db, item):
+        # Whether the database already holds the item's record.
+        return self.item_version(item) is not None and db.is_current(item, self.artist_counts(item))
+
+    def log_item(self, describe, item):
+        # Per-item lines are debug only; progress summaries replace them.
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(describe(item))
+        self.progress.update()
+
+    def item_data(self, item):
+        if 'detail' in self.fields and not item.isFullObject():
+            item.reload()
+        data = {}
+        if 'ids' in self.fields:
+            # Ids are only kept until the item's row is built, so memory
+            # stays bounded by the items in flight.
+            data['ids'] = self.ids.pop(item.ratingKey, {})
+        if 'album' in self.fields:
+            data['album'] = self.albums.get(item.parentRatingKey)
+        if 'artist' in self.fields:
+            data['artist'] = self.artists.get(item.grandparentRatingKey)
+        if 'counts' in self.fields and item.type in ('show', 'artist'):
+            data['counts'] = self.fetch_show_counts(
+                item) if item.type == 'show' else self.fetch_artist_counts(item)
+        return data
+
+    def child_lookups(self, item):
+        # Child endpoints the async engine still has to count for an item,
+        # after bulk counts, the metadata cache and incremental state.
+        if 'counts' not in self.fields or item.type not in ('show', 'artist'):
+            return ()
+        if item.type == 'show' and self.bulk_counts and show_counts(item) is not None:
+            return ()
+        if item.type == 'artist' and self.counts is not None:
+            return ()
+        if self.cached_rows(item) is not None:
+            return ()
+        missing = []
+        version = self.cache_version(item)
+        for endpoint in ('children', 'allLeaves'):
+            value = self.cache.get(endpoint, item.ratingKey,
+                                   version) if version is not None else None
+            if value is None:
+                missing.append(endpoint)
+            else:
+                self.child_counts.setdefault(item.ratingKey, {})[
+                    endpoint] = value
+        return missing
+
+    def counted(self, item, counts):
+        self.child_counts.setdefault(item.ratingKey, {}).update(counts)
+        version = self.cache_version(item)
+        if version is not None:
+            for endpoint, value in counts.items():
+                self.cache.set(endpoint, item.ratingKey, version, value)
+
+    def known_counts(self, item):
+        counts = self.child_counts.get(item.ratingKey, {})
+        if 'children' in counts and 'allLeaves' in counts:
+            return counts['children'], counts['allLeaves']
+        return None
+
+    def fetch_show_counts(self, show):
+        counts = show_counts(show) if self.bulk_counts else None
+        if counts is None:
+            counts = self.known_counts(show)
+        if counts is not None:
+            return counts
+        seasons = self.cached('children', show, lambda: len(show.seasons()))
+        episodes = self.cached(
+            'allLeaves', show, lambda: len(show.episodes()))
+        return seasons, episodes
+
+    def fetch_artist_counts(self, artist):
+        if self.counts is not None:
+            return self.counts.get(artist.ratingKey, (0, 0))
+        counts = self.known_counts(artist)
+        if counts is not None:
+            return counts
+        # Artist.albums() goes through a filtered section search; the
+        # children endpoint returns the same albums in one plain request.
+        albums = self.cached('children', artist, lambda: len(
+            artist.fetchItems(f"{artist.key}/children")))
+        tracks = self.cached(
+            'allLeaves', artist, lambda: len(artist.tracks()))
+        return albums, tracks
+
+    def cache_version(self, item):
+        # Nothing in an artist's listing changes when albums or tracks are
+        # added, so per-artist counts aren't cached.
+        if self.cache is None or item.type == 'artist':
+            return None
+        return item_version(item)
+
+    def cached(self, endpoint, item, fetch):
+        version = self.cache_version(item)
+        if version is None:
+            with metrics.phase('parse'):
+                return fetch()
+        value = self.cache.get(endpoint, item.ratingKey, version)
+        if value is None:
+            with metrics.phase('parse'):
+                value = fetch()
+            self.cache.set(endpoint, item.ratingKey, version, value)
+        return value
@@ -0,0 +1,128 @@
+import datetime
+import logging
+from urllib.parse import urlencode
+from plexapi.exceptions import BadRequest, NotFound
+from plexapi.utils import searchType
+
+# Export filters by option name: the Plex filter field, the item types the
+# filter means something for and the types only the server can check (the
+# listing has no resolution for shows and rarely a year for tracks).
+FILTERS = {
+    'added_since': ('addedAt>>', ('movie', 'show', 'artist', 'track'), ()),
+    'updated_since': ('updatedAt>>', ('movie', 'show', 'artist', 'track'), ()),
+    'year': ('year', ('movie', 'show', 'track'), ('track',)),
+    'genre': ('genre', ('movie', 'show', 'artist'), ()),
+    'resolution': ('resolution', ('movie', 'show'), ('show',)),
+    'unwatched': ('unwatched', ('movie', 'show', 'track'), ()),
+}
+
+
+def resolutions(item):
+    return {(media.videoResolution or '').casefold() for media in getattr(item, 'media', None) or []}
+
+
+def unwatched(item):
+    if item.type == 'show':
+        return (item.viewedLeafCount or 0) < (item.leafCount or 0)
+    return not item.viewCount
+
+
+CHECKS = {
+    'added_since': lambda item, value: item.addedAt is not None and item.addedAt >= value,
+    'updated_since': lambda item, value: item.updatedAt is not None and item.updatedAt >= value,
+    'year': lambda item, value: item.year in value,
+    'genre': lambda item, value: any(genre.tag.casefold() in value for genre in item.genres or []),
+    'resolution': lambda item, value: not resolutions(item).isdisjoint(value),
+    'unwatched': lambda item, value: unwatched(item) == value,
+}
+
+
+def client_value(name, value):
+    if name in ('genre', 'resolution'):
+        return {entry.casefold() for entry in value}
+    if name == 'year':
+        return set(value)
+    return value
+
+
+def filter_param(section, field, value, libtype):
+    # The listing parameter of a filter, checked against the filter fields,
+    # operators and choices the section reports for libtype.
+    name = field.rstrip('>')
+    operator = field[len(name):] + '='
+    field = next((entry for entry in section.listFields(libtype) if entry.key.split('.')[-1] == name), None)
+    if field is None:
+        raise NotFound(f'Unknown filter field "{name}" for libtype "{libtype}"')
+    field_type = section.getFieldType(field.type)
+    if operator not in {entry.key for entry in field_type.operators}:
+        raise NotFound(f'Unknown operator "{operator}" for filter field "{field.key}"')
+    values = value if isinstance(value, list) else [value]
+    if field_type.type == 'boolean':
+        values = [int(bool(value)) for value in values]
+    elif field_type.type == 'date':
+        values = [int(value.timestamp()) for value in values]
+    elif field_type.type in ('tag', 'resolution'):
+        choices = {}
+        for choice in section.listFilterChoices(field.key, libtype):
+            choices.setdefault(choice.title.casefold(), choice.key)
+            choices.setdefault(choice.key.casefold(), choice.key)
+        values = [choices.get(str(value).casefold(), value) for value in values]
+    return urlencode({field.key + operator[:-1]: ','.join(str(value) for value in values)})
+
+
+def filter_label(filters):
+    # Names the outputs of a filtered export, e.g. "year 2010+2011,
+    # unwatched", so they never replace the outputs of full exports.
+    parts = []
+    for name, value in filters.items():
+        if isinstance(value, datetime.datetime):
+            value = value.strftime('%Y-%m-%d' if value.time() == datetime.time() else '%Y-%m-%dT%H%M')
+        elif isinstance(value, list):
+            value = '+'.join(str(entry) for entry in value)
+        label = name.replace('_', ' ') if value is True else f"{name.replace('_', ' ')} {value}"
+        parts.append("".join(character if character.isalnum() or character in " -_.+" else "_"
+                             for character in label))
+    return ", ".join(parts)
+
+
+class SectionFilter:
+    # The filters of an export applied to one section. Filters the server
+    # accepts are sent with the listing, so non-matching items never leave
+    # it; the others are checked on every listed item.
+    def __init__(self, params, checks) -> None:
+        self.params = params
+        self.checks = checks
+
+    @classmethod
+    def plan(cls, section, item_type, libtype, filters):
+        # Returns None when a filter can't be applied to the section at all.
+        params = []
+        checks = []
+        for name, value in filters.items():
+            field, types, server_only = FILTERS[name]
+            if item_type not in types:
+                logging.info(
+                    f"--{name.replace('_', '-')} doesn't apply to {item_type}s, skipping {section.title}")
+                return None
+            try:
+                params.append(filter_param(
+                    section, field, value, libtype or section.TYPE))
+            except (BadRequest, NotFound) as e:
+                if item_type in server_only:
+                    logging.warning(
+                        f"{section.title} can't be filtered by --{name.replace('_', '-')}, skipping: {e}")
+                    return None
+                logging.info(
+                    f"{section.title} doesn't support the {field} filter, checking items instead: {e}")
+                checks.append((CHECKS[name], client_value(name, value)))
+        return cls(params, checks)
+
+    def key(self, section, libtype, include_guids):
+        # The listing request with every filter the server accepted.
+        params = {'includeGuids': int(include_guids)}
+        if libtype is not None:
+            params['type'] = searchType(libtype)
+        return '&'.join([f"/library/sections/{section.key}/all?" + urlencode(params)] + self.params)
+
+    def matches(self, item):
+        return all(check(item, value) for check, value in self.checks)
@@ -0,0 +1,11 @@
+import datetime
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def format_value(value):
+    # Rows keep typed values so xlsx can store real dates; text formats
+    # render them with the same layout the exports have always used.
+    if isinstance(value, datetime.datetime):
+        return value.strftime(DATE_FORMAT)
+    return value
@@ -1,6 +1,10 @@
-import coloredlogs
+import atexit
 import logging
 import os
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
 
 
 class AutoFlushStreamHandler(logging.StreamHandler):
@@ -9,8 +13,39 @@ class AutoFlushStreamHandler(logging.StreamHandler):
         self.flush()
 
 
+class DeferredQueueHandler(QueueHandler):
+    # QueueHandler.prepare formats the message on the calling thread; the
+    # listener thread formats it instead so the export loop only enqueues.
+    def prepare(self, record):
+        return record
+
+
+def setup_queue_logging(level, log_filename):
+    # Records are formatted and written on the listener thread; progress
+    # lines are already limited to one per interval by app.progress.
+    import coloredlogs
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(coloredlogs.ColoredFormatter(LOG_FORMAT))
+    file_handler = logging.FileHandler(log_filename, mode='w')
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, stream_handler,
+                             file_handler, respect_handler_level=True)
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(DeferredQueueHandler(log_queue))
+    root.setLevel(level)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
 def setup_logging():
-    coloredlogs.install()
+    LOG_QUEUE = os.getenv("LOG_QUEUE", "false").lower() in ("true", "1", "yes")
+    if not LOG_QUEUE:
+        import coloredlogs
+        coloredlogs.install()
     LOG_DIR = os.getenv("LOG_DIR", "logs")
     if LOG_DIR == "logs":
         logging.warning(
@@ -27,9 +62,12 @@ def setup_logging():
     if not os.path.exists(LOG_DIR):
         os.makedirs(LOG_DIR)
     log_filename = os.path.join(LOG_DIR, 'plexport.log')
+    if LOG_QUEUE:
+        setup_queue_logging(LOG_LEVEL or logging.INFO, log_filename)
+        return
     logging.basicConfig(
         level=LOG_LEVEL,
-        format='%(asctime)s - %(levelname)s - %(message)s',
+        format=LOG_FORMAT,
         handlers=[
             logging.FileHandler(log_filename, mode='w'),
             AutoFlushStreamHandler()
@@ -0,0 +1,101 @@
+import csv
+import logging
+import os
+import re
+from collections import namedtuple
+
+MATCH_SOURCES = ['tmdb', 'imdb', 'tvdb']
+NON_ALPHANUMERIC = re.compile(r'[\W_]+')
+DUPLICATE_HEADERS = ['Group', 'Type', 'Title', 'Year', 'Matched On', 'Server', 'Section', 'Rating Key']
+MISSING_HEADERS = ['Type', 'Title', 'Year', 'Missing From', 'Present On']
+
+MatchItem = namedtuple(
+    'MatchItem', ['server', 'section', 'type', 'rating_key', 'title', 'year', 'ids'])
+
+
+def title_key(item):
+    title = NON_ALPHANUMERIC.sub(' ', (item.title or '').casefold()).strip()
+    return ('title', item.type, title, item.year)
+
+
+def find(parents, index):
+    while parents[index] != index:
+        parents[index] = parents[parents[index]]
+        index = parents[index]
+    return index
+
+
+def group_items(items):
+    # Items sharing any tmdb/imdb/tvdb id are one title. Items without
+    # those ids fall back to a normalized title and year, matching either
+    # another id-less item or the first item with ids and the same title.
+    # Every key is a dict lookup and groups are merged with union-find, so
+    # this stays roughly linear in the number of items.
+    parents = list(range(len(items)))
+    owners = {}
+    reasons = {}
+
+    def union(index, key):
+        owner = owners.setdefault(key, index)
+        if owner != index:
+            root, other = find(parents, index), find(parents, owner)
+            if root != other:
+                parents[root] = other
+            reasons.setdefault(index, set()).add(key[0])
+
+    for index, item in enumerate(items):
+        keys = [(source, item.type, item.ids[source])
+                for source in MATCH_SOURCES if source in item.ids]
+        for key in keys:
+            union(index, key)
+        if keys:
+            owners.setdefault(title_key(item), index)
+    for index, item in enumerate(items):
+        if not any(source in item.ids for source in MATCH_SOURCES):
+            union(index, title_key(item))
+
+    groups = {}
+    for index in range(len(items)):
+        groups.setdefault(find(parents, index), []).append(index)
+    return [([items[index] for index in group],
+             ', '.join(sorted(set().union(*(reasons.get(index, ()) for index in group)))))
+            for group in groups.values()]
+
+
+def match(items, export_dir):
+    # Writes duplicates.csv (titles held more than once across all servers
+    # and sections) and missing.csv (titles absent from servers that have
+    # items of the same type).
+    groups = group_items(items)
+    servers_by_type = {}
+    for item in items:
+        servers_by_type.setdefault(item.type, set()).add(item.server)
+
+    duplicates = [(group, reason)
+                  for group, reason in groups if len(group) > 1]
+    duplicates_file = os.path.join(export_dir, "duplicates.csv")
+    with open(duplicates_file, mode='w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerow(DUPLICATE_HEADERS)
+        for number, (group, reason) in enumerate(duplicates, 1):
+            for item in group:
+                writer.writerow([number, item.type, item.title, item.year, reason,
+                                 item.server, item.section, item.rating_key])
+
+    missing = 0
+    missing_file = os.path.join(export_dir, "missing.csv")
+    with open(missing_file, mode='w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerow(MISSING_HEADERS)
+        for group, _ in groups:
+            first = group[0]
+            present = sorted({item.server for item in group})
+            absent = sorted(servers_by_type[first.type] - set(present))
+            if absent:
+                missing += 1
+                writer.writerow([first.type, first.title, first.year,
+                                 ', '.join(absent), ', '.join(present)])
+
+    logging.info(
+        f"Matched {len(items)} items into {len(groups)} titles: {len(duplicates)} duplicated "
+        f"(see {duplicates_file}), {missing} missing from a server (see {missing_file})")
@@ -0,0 +1,191 @@
+import heapq
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+SLOWEST_ITEMS = 10
+PHASES = ['network', 'parse', 'build', 'write']
+
+
+def new_section():
+    return {
+        'items': 0,
+        'requests': 0,
+        'bytes': 0,
+        'wall': 0.0,
+        'phases': {phase: 0.0 for phase in PHASES},
+        'slowest': [],
+    }
+
+
+class Metrics:
+    # Collects per-section request counts, bytes and time spent per phase.
+    # Phase times are summed across worker threads, and time spent in HTTP
+    # requests or nested phases is booked there rather than to the outer phase.
+    # The current section is tracked per thread so several servers can be
+    # exported at once; worker threads run bound to their caller's section.
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        self.sections = {}
+        self.local.section = None
+        self.started = time.time()
+
+    @property
+    def section(self):
+        return getattr(self.local, 'section', None)
+
+    def attach(self, session):
+        session.hooks.setdefault('response', []).append(self.on_response)
+
+    def start_section(self, title):
+        with self.lock:
+            self.local.section = self.sections.setdefault(title, new_section())
+        self.local.section_started = time.monotonic()
+
+    def end_section(self):
+        if self.section is not None:
+            self.section['wall'] += time.monotonic() - self.local.section_started
+        self.local.section = None
+
+    def bind(self, func):
+        # Returns func wrapped to book its metrics to the caller's section
+        # when it runs on another thread.
+        section = self.section
+
+        def bound(*args, **kwargs):
+            previous = self.section
+            self.local.section = section
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.local.section = previous
+        return bound
+
+    def accounted_time(self):
+        return getattr(self.local, 'accounted', 0.0)
+
+    def on_response(self, response, *args, **kwargs):
+        size = int(response.headers.get(
+            'Content-Length') or len(response.content))
+        self.request(size, response.elapsed.total_seconds())
+
+    def request(self, size, elapsed):
+        self.local.accounted = self.accounted_time() + elapsed
+        with self.lock:
+            section = self.section if self.section is not None else self.sections.setdefault(
+                '(server)', new_section())
+            section['requests'] += 1
+            section['bytes'] += size
+            section['phases']['network'] += elapsed
+
+    @contextmanager
+    def phase(self, name):
+        accounted_before = self.accounted_time()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            total = time.perf_counter() - started
+            elapsed = total - (self.accounted_time() - accounted_before)
+            self.local.accounted = accounted_before + total
+            section = self.section
+            if section is not None:
+                with self.lock:
+                    section['phases'][name] += elapsed
+
+    def item(self, title, seconds):
+        section = self.section
+        if section is None:
+            return
+        with self.lock:
+            section['items'] += 1
+            entry = (seconds, title)
+            if len(section['slowest']) < SLOWEST_ITEMS:
+                heapq.heappush(section['slowest'], entry)
+            elif entry > section['slowest'][0]:
+                heapq.heapreplace(section['slowest'], entry)
+
+    def summary(self):
+        sections = {}
+        for title, section in self.sections.items():
+            wall = section['wall']
+            sections[title] = {
+                'items': section['items'],
+                'requests': section['requests'],
+                'bytes': section['bytes'],
+                'wall_seconds': round(wall, 3),
+                'items_per_second': round(section['items'] / wall, 2) if wall else 0,
+                'phase_seconds': {phase: round(seconds, 3) for phase, seconds in section['phases'].items()},
+                'slowest_items': [{'title': title, 'seconds': round(seconds, 3)}
+                                  for seconds, title in sorted(section['slowest'], reverse=True)],
+            }
+        finished = time.time()
+        return {
+            'started_at': round(self.started, 3),
+            'finished_at': round(finished, 3),
+            'wall_seconds': round(finished - self.started, 3),
+            'items': sum(section['items'] for section in sections.values()),
+            'requests': sum(section['requests'] for section in sections.values()),
+            'bytes': sum(section['bytes'] for section in sections.values()),
+            'sections': sections,
+        }
+
+    def write_json(self, filename):
+        write_atomic(filename, json.dumps(self.summary(), indent=2))
+
+    def write_prometheus(self, filename):
+        # Textfile collector format for node_exporter.
+        summary = self.summary()
+        lines = [
+            '# HELP plexport_last_run_timestamp_seconds Time the last export finished.',
+            '# TYPE plexport_last_run_timestamp_seconds gauge',
+            f"plexport_last_run_timestamp_seconds {summary['finished_at']}",
+            '# HELP plexport_run_duration_seconds Wall time of the last export.',
+            '# TYPE plexport_run_duration_seconds gauge',
+            f"plexport_run_duration_seconds {summary['wall_seconds']}",
+        ]
+        gauges = [
+            ('items', 'items', 'Items exported per section.'),
+            ('requests', 'requests', 'HTTP requests made per section.'),
+            ('bytes', 'response_bytes', 'HTTP response bytes per section.'),
+            ('wall_seconds', 'duration_seconds', 'Wall time per section.'),
+            ('items_per_second', 'items_per_second',
+             'Export throughput per section.'),
+        ]
+        for key, name, help in gauges:
+            lines.append(f"# HELP plexport_section_{name} {help}")
+            lines.append(f"# TYPE plexport_section_{name} gauge")
+            for title, section in summary['sections'].items():
+                lines.append(
+                    f"plexport_section_{name}{{section=\"{escape_label(title)}\"}} {section[key]}")
+        lines.append(
+            '# HELP plexport_section_phase_seconds Time spent per export phase, summed across threads.')
+        lines.append('# TYPE plexport_section_phase_seconds gauge')
+        for title, section in summary['sections'].items():
+            for phase, seconds in section['phase_seconds'].items():
+                lines.append(
+                    f"plexport_section_phase_seconds{{section=\"{escape_label(title)}\",phase=\"{phase}\"}} {seconds}")
+        write_atomic(filename, '\n'.join(lines) + '\n')
+
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def write_atomic(filename, content):
+    directory = os.path.dirname(filename)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temp_filename = f"{filename}.tmp"
+    with open(temp_filename, 'w', encoding='utf-8') as file:
+        file.write(content)
+    os.replace(temp_filename, filename)
+
+
+metrics = Metrics()
@@ -0,0 +1,53 @@
+from concurrent.futures import ThreadPoolExecutor
+from app.defaults import PAGE_SIZE
+from app.metrics import metrics
+
+
+def iter_section(section, page_size=PAGE_SIZE, libtype=None, start=0, key=None, **kwargs):
+    # Streams a section one container page at a time, fetching the next page
+    # in the background while the current one is being written. key is a
+    # listing request built beforehand, e.g. with filters.
+    def fetch_page(start):
+        with metrics.phase('parse'):
+            if key is not None:
+                return section.fetchItems(key, container_start=start, container_size=page_size,
+                                          maxresults=page_size)
+            return section.search(libtype=libtype, container_start=start,
+                                  container_size=page_size, maxresults=page_size, **kwargs)
+
+    fetch_page = metrics.bind(fetch_page)
+    executor = ThreadPoolExecutor(max_workers=1)
+    try:
+        page = executor.submit(fetch_page, start)
+        while page is not None:
+            items = page.result()
+            start += len(items)
+            page = executor.submit(
+                fetch_page, start) if len(items) >= page_size else None
+            yield from items
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def total_size(plex, key):
+    # Number of items a listing request matches, without fetching any.
+    data = plex.query(
+        f"{key}&X-Plex-Container-Start=0&X-Plex-Container-Size=0")
+    return int(data.attrib.get('totalSize', 0))
+
+
+def iter_listing(plex, section, type, page_size=PAGE_SIZE):
+    # Streams the raw XML elements of one type in a section, for indexes
+    # that only need a few attributes and not full plexapi objects.
+    start = 0
+    while True:
+        with metrics.phase('parse'):
+            data = plex.query(
+                f"/library/sections/{section.key}/all?type={type}"
+                f"&X-Plex-Container-Start={start}&X-Plex-Container-Size={page_size}")
+        elements = list(data)
+        yield from elements
+        start += len(elements)
+        total = int(data.attrib.get('totalSize', start))
+        if not elements or start >= total:
+            break
@@ -1,21 +1,59 @@
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 from plexapi.server import PlexServer
 from plexapi.exceptions import Unauthorized
 from requests.exceptions import ConnectionError
+from app.defaults import TIMEOUT
 
 
-def connect_plex():
+def connect_plex(url=None, token=None, session=None, timeout=TIMEOUT):
+    # session is shared by every request to the server, see app.session.
+    plex = None
     try:
-        PLEX_URL = os.environ.get("PLEX_URL")
-        PLEX_TOKEN = os.environ.get("PLEX_TOKEN")
-        logging.info("Connecting to Plex server...")
-        plex = PlexServer(PLEX_URL, PLEX_TOKEN, timeout=10)
-        logging.info("Successfully connected to Plex server!")
+        PLEX_URL = url or os.environ.get("PLEX_URL")
+        PLEX_TOKEN = token or os.environ.get("PLEX_TOKEN")
+        logging.info(f"Connecting to Plex server {PLEX_URL}...")
+        plex = PlexServer(PLEX_URL, PLEX_TOKEN, session=session, timeout=timeout)
+        logging.info(f"Successfully connected to Plex server {plex.friendlyName}!")
     except Unauthorized as e:
         logging.error(f"Failed to connect to Plex server: 401 Unauthorized. Check your PLEX_URL and PLEX_TOKEN")
     except ConnectionError as e:
         logging.error(f"Failed to connect to Plex server: {e}")
     except Exception as e:
         logging.error(f"Failed to connect to Plex server: {e}")
-    return plex
\ No newline at end of file
+    return plex
+
+
+def connect_servers(session=None, timeout=TIMEOUT):
+    # PLEX_URL may list several servers separated by commas. PLEX_TOKEN is
+    # either one token for all of them or one token per server.
+    urls = [url.strip() for url in os.environ.get(
+        "PLEX_URL", "").split(",") if url.strip()]
+    tokens = [token.strip()
+              for token in os.environ.get("PLEX_TOKEN", "").split(",")]
+    if len(tokens) == 1:
+        tokens = tokens * len(urls)
+    if len(tokens) != len(urls):
+        logging.error("PLEX_TOKEN must hold one token, or one token per PLEX_URL.")
+        return []
+    if len(urls) <= 1:
+        servers = [connect_plex(session=session, timeout=timeout)]
+    else:
+        with ThreadPoolExecutor(max_workers=len(urls)) as executor:
+            servers = list(executor.map(lambda url, token: connect_plex(url, token, session, timeout),
+                                        urls, tokens))
+    return [plex for plex in servers if plex is not None]
+
+
+def server_names(servers):
+    # Directory-safe names for each server, unique even when several
+    # servers share a friendly name.
+    names = []
+    for plex in servers:
+        name = "".join(character if character.isalnum() or character in " -_." else "_"
+                       for character in plex.friendlyName).strip() or plex.machineIdentifier
+        if name in names:
+            name = f"{name}-{plex.machineIdentifier[:8]}"
+        names.append(name)
+    return names
@@ -0,0 +1,29 @@
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from app.metrics import metrics
+
+
+def map_ordered(func, items, workers=1):
+    # Yields (item, func(item)) pairs in the same order as items while at
+    # most workers * 2 calls are queued, so lazy inputs stay lazy.
+    func = metrics.bind(func)
+    if workers <= 1:
+        for item in items:
+            yield item, func(item)
+        return
+    items = iter(items)
+    executor = ThreadPoolExecutor(max_workers=workers)
+    pending = deque()
+    try:
+        for item in itertools.islice(items, workers * 2):
+            pending.append((item, executor.submit(func, item)))
+        while pending:
+            item, future = pending.popleft()
+            result = future.result()
+            for next_item in itertools.islice(items, 1):
+                pending.append(
+                    (next_item, executor.submit(func, next_item)))
+            yield item, result
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,40 @@
+import datetime
+import logging
+import time
+
+PROGRESS_INTERVAL = 10.0
+
+
+class Progress:
+    # Logs one summary line per interval (count, rate and ETA) in place of a
+    # line per exported item.
+    def __init__(self, label, total=None, interval=PROGRESS_INTERVAL) -> None:
+        self.label = label
+        self.total = total
+        self.interval = interval
+        self.count = 0
+        self.started = time.monotonic()
+        self.last_logged = self.started
+
+    def update(self, count=1):
+        self.count += count
+        now = time.monotonic()
+        if now - self.last_logged >= self.interval:
+            self.last_logged = now
+            self.log(now)
+
+    def log(self, now=None):
+        elapsed = (now or time.monotonic()) - self.started
+        rate = self.count / elapsed if elapsed > 0 else 0
+        if self.total:
+            eta = datetime.timedelta(
+                seconds=round((self.total - self.count) / rate)) if rate else "unknown"
+            logging.info(
+                f"{self.label}: {self.count}/{self.total} items ({rate:.1f}/s, ETA {eta})")
+        else:
+            logging.info(f"{self.label}: {self.count} items ({rate:.1f}/s)")
+
+    def finish(self):
+        elapsed = datetime.timedelta(
+            seconds=round(time.monotonic() - self.started))
+        logging.info(f"{self.label}: exported {self.count} items in {elapsed}")
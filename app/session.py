@@ -0,0 +1,60 @@
+import logging
+import random
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from app.defaults import RETRIES
+
+BACKOFF = 0.5
+MAX_BACKOFF = 30.0
+# Statuses worth retrying: Plex answers 503 while a library is busy, and
+# proxies in front of it time out with 502/504.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Responses smaller than this are not worth compressing.
+COMPRESSIBLE_SIZE = 16 * 1024
+
+
+def backoff_delay(attempt, backoff=BACKOFF):
+    # Exponential backoff with full jitter, so workers that failed together
+    # don't retry together.
+    return random.uniform(0, min(MAX_BACKOFF, backoff * 2 ** attempt))
+
+
+class JitteredRetry(Retry):
+    def get_backoff_time(self):
+        retries = len([entry for entry in self.history if entry.redirect_location is None])
+        return backoff_delay(retries - 1, self.backoff_factor) if retries > 1 else 0
+
+
+def new_session(pool_size, retries=RETRIES, backoff=BACKOFF):
+    # One keep-alive pool per server, sized for the threads that talk to it
+    # at the same time. Idempotent requests that fail to connect, time out
+    # or hit a transient status are retried; Retry-After is honoured.
+    session = requests.Session()
+    retry = JitteredRetry(total=retries, connect=retries, read=retries, status=retries,
+                          backoff_factor=backoff, status_forcelist=RETRY_STATUSES,
+                          allowed_methods=Retry.DEFAULT_ALLOWED_METHODS, raise_on_status=False)
+    adapter = HTTPAdapter(pool_maxsize=pool_size, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['Accept-Encoding'] = 'gzip, deflate'
+    session.hooks['response'].append(check_compression())
+    return session
+
+
+def check_compression():
+    # Warns once per session when large responses arrive uncompressed, e.g.
+    # behind a proxy that strips Accept-Encoding.
+    warned = False
+
+    def hook(response, *args, **kwargs):
+        nonlocal warned
+        if warned or response.headers.get('Content-Encoding'):
+            return
+        size = int(response.headers.get('Content-Length') or 0)
+        if size >= COMPRESSIBLE_SIZE:
+            warned = True
+            logging.warning(
+                f"{response.url.split('?')[0]} returned {size} bytes uncompressed; "
+                f"check that nothing between plexport and Plex strips gzip")
+    return hook
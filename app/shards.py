@@ -0,0 +1,284 @@
+import bz2
+import csv
+import datetime
+import hashlib
+import io
+import json
+import lzma
+import os
+import zlib
+from collections import namedtuple
+from app.checkpoint import partial_filename
+from app.formatting import DATE_FORMAT
+from app.metrics import write_atomic
+from app.snapshot import value_kind
+
+MANIFEST_SUFFIX = '.manifest.json'
+SHARDED_FORMATS = ['csv', 'jsonl']
+GZIP_LEVEL = 6
+HASH_CHUNK_SIZE = 1024 * 1024
+# Manifest types of the snapshot column kinds.
+SCHEMA_TYPES = {'empty': 'null', 'int': 'integer', 'float': 'float', 'date': 'datetime', 'category': 'string'}
+
+# How the text outputs of a section are written: compression is one of
+# app.defaults.COMPRESSIONS, shard_rows and shard_bytes (uncompressed) bound each shard
+# and are None when unbounded.
+Output = namedtuple('Output', ['compression', 'shard_rows', 'shard_bytes'])
+
+
+class Plain:
+    def compress(self, data):
+        return data
+
+    def flush(self):
+        return b''
+
+
+def zstd_compressor():
+    try:
+        import zstandard
+    except ImportError as e:
+        raise RuntimeError(
+            "zstd compression needs zstandard. Install it with: pip install zstandard") from e
+    return zstandard.ZstdCompressor().compressobj()
+
+
+# Compression -> (file extension, compressor factory). Every codec's
+# compressor ends a complete stream on flush(), and concatenated streams
+# read back as one file.
+CODECS = {
+    'none': ('', Plain),
+    'gzip': ('.gz', lambda: zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)),
+    'bz2': ('.bz2', bz2.BZ2Compressor),
+    'xz': ('.xz', lambda: lzma.LZMACompressor(format=lzma.FORMAT_XZ)),
+    'zstd': ('.zst', zstd_compressor),
+}
+
+
+def check_compression(compression):
+    # Fails before the export starts when the codec's package is missing.
+    CODECS[compression][1]()
+
+
+def manifest_filename(filename):
+    return filename + MANIFEST_SUFFIX
+
+
+def shard_filename(filename, output, index):
+    # Movies.csv -> Movies.csv.gz, or Movies-00000.csv.gz when sharded.
+    extension = CODECS[output.compression][0]
+    if output.shard_rows is None and output.shard_bytes is None:
+        return filename + extension
+    root, format_extension = os.path.splitext(filename)
+    return f"{root}-{index:05d}{format_extension}{extension}"
+
+
+def file_sha256(filename, size=None):
+    # sha256 of the first size bytes of filename, as a hash object.
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as file:
+        remaining = os.path.getsize(filename) if size is None else size
+        while remaining > 0:
+            chunk = file.read(min(HASH_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            digest.update(chunk)
+            remaining -= len(chunk)
+    return digest
+
+
+def merge_kind(kind, value):
+    # Widens a column kind the way app.snapshot.ColumnBuilder does.
+    if value is None:
+        return kind
+    new = value_kind(value)
+    if new == kind or kind == 'empty':
+        return new
+    if {kind, new} == {'int', 'float'}:
+        return 'float'
+    return 'category'
+
+
+class ShardedFile:
+    # A text file for csv.writer and JsonlSink that streams into compressed
+    # shards on the sink thread. end_row() closes the current shard once it
+    # holds shard_rows rows or shard_bytes uncompressed bytes, so shards
+    # always hold whole rows; the next write opens the next one and calls
+    # on_open() to repeat the header. Shards are written to partial files
+    # that commit() renames before it writes the manifest.
+    #
+    # Checkpoints end the current compressed stream and start a new one in
+    # the same file, so a resumed export can cut the shard back to the
+    # offset of its checkpoint and keep appending.
+    def __init__(self, filename, format, headers, output, on_open, position=None) -> None:
+        self.filename = filename
+        self.format = format
+        self.headers = headers
+        self.output = output
+        self.on_open = on_open
+        self.new_compressor = CODECS[output.compression][1]
+        position = position or {}
+        self.shards = list(position.get('shards', []))
+        self.kinds = position.get('kinds') or ['empty'] * len(headers)
+        self.file = None
+        self.compressor = None
+        self.digest = None
+        self.rows = 0
+        self.size = 0
+        if position.get('offset') is not None:
+            self.open_shard(len(self.shards), position)
+
+    @property
+    def index(self):
+        return len(self.shards)
+
+    def open_shard(self, index, position=None):
+        path = partial_filename(shard_filename(self.filename, self.output, index))
+        if position:
+            os.truncate(path, position['offset'])
+            self.digest = file_sha256(path)
+            self.file = open(path, 'ab')
+            self.rows = position['rows']
+            self.size = position['size']
+        else:
+            self.digest = hashlib.sha256()
+            self.file = open(path, 'wb')
+            self.rows = 0
+            self.size = 0
+        self.compressor = self.new_compressor()
+        if not position:
+            self.on_open()
+
+    def write(self, text):
+        if self.file is None:
+            self.open_shard(self.index)
+        data = text.encode('utf-8')
+        self.size += len(data)
+        self.emit(self.compressor.compress(data))
+
+    def emit(self, data):
+        if data:
+            self.file.write(data)
+            self.digest.update(data)
+
+    def end_row(self, row):
+        self.rows += 1
+        self.kinds = [merge_kind(kind, value) for kind, value in zip(self.kinds, row)]
+        if ((self.output.shard_rows is not None and self.rows >= self.output.shard_rows)
+                or (self.output.shard_bytes is not None and self.size >= self.output.shard_bytes)):
+            self.close_shard()
+
+    def close_shard(self):
+        self.emit(self.compressor.flush())
+        self.file.close()
+        self.shards.append({'path': os.path.basename(shard_filename(self.filename, self.output, self.index)),
+                            'rows': self.rows, 'bytes': os.path.getsize(self.file.name),
+                            'uncompressed_bytes': self.size, 'sha256': self.digest.hexdigest()})
+        self.file = None
+
+    def sync(self):
+        # Returns the checkpoint position: the closed shards and where the
+        # open one ends, or offset None between shards.
+        offset = None
+        if self.file is not None:
+            self.emit(self.compressor.flush())
+            self.compressor = self.new_compressor()
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            offset = self.file.tell()
+        return {'shards': list(self.shards), 'offset': offset, 'rows': self.rows, 'size': self.size,
+                'kinds': list(self.kinds)}
+
+    def close(self):
+        if self.file is None and not self.shards:
+            # An empty section still gets a shard, with only the header.
+            self.open_shard(0)
+        if self.file is not None:
+            self.close_shard()
+
+    def commit(self):
+        manifest = manifest_filename(self.filename)
+        directory = os.path.dirname(self.filename)
+        previous = read_manifest(manifest)
+        for shard in self.shards:
+            path = os.path.join(directory, shard['path'])
+            os.replace(partial_filename(path), path)
+        write_atomic(manifest, json.dumps({
+            'format': self.format,
+            'compression': self.output.compression,
+            'rows': sum(shard['rows'] for shard in self.shards),
+            'schema': [{'name': header, 'type': SCHEMA_TYPES[kind]}
+                       for header, kind in zip(self.headers, self.kinds)],
+            'datetime_format': DATE_FORMAT,
+            'shards': self.shards,
+            'created_at': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        }, indent=2))
+        # Shards of the previous export that this one didn't overwrite.
+        current = {shard['path'] for shard in self.shards}
+        for shard in previous['shards'] if previous else []:
+            path = os.path.join(directory, shard['path'])
+            if shard['path'] not in current and os.path.exists(path):
+                os.remove(path)
+
+
+def resumable(filename, output, position):
+    # Whether the partial shards still match a checkpoint position.
+    if not isinstance(position, dict):
+        return False
+    for index, shard in enumerate(position['shards']):
+        path = partial_filename(shard_filename(filename, output, index))
+        if os.path.basename(shard_filename(filename, output, index)) != shard['path']:
+            return False
+        if not os.path.exists(path) or os.path.getsize(path) != shard['bytes']:
+            return False
+    if position['offset'] is None:
+        return True
+    path = partial_filename(shard_filename(filename, output, len(position['shards'])))
+    return os.path.exists(path) and os.path.getsize(path) >= position['offset']
+
+
+def read_manifest(filename):
+    if not os.path.exists(filename):
+        return None
+    with open(filename, encoding='utf-8') as file:
+        return json.load(file)
+
+
+def open_shard(path):
+    # Opens a shard for reading as text, decompressing by its extension.
+    if path.endswith('.gz'):
+        import gzip
+        return gzip.open(path, 'rt', newline='', encoding='utf-8')
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'rt', newline='', encoding='utf-8')
+    if path.endswith('.xz'):
+        return lzma.open(path, 'rt', newline='', encoding='utf-8')
+    if path.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError as e:
+            raise RuntimeError(
+                "Reading zstd shards needs zstandard. Install it with: pip install zstandard") from e
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(
+            open(path, 'rb'), read_across_frames=True, closefd=True), newline='', encoding='utf-8')
+    return open(path, newline='', encoding='utf-8')
+
+
+def read_sharded_rows(filename):
+    # Returns every row of the shards listed in a manifest, including the
+    # header row, like app.state.read_rows.
+    manifest = read_manifest(filename)
+    if manifest is None:
+        return []
+    directory = os.path.dirname(filename)
+    headers = [column['name'] for column in manifest['schema']]
+    rows = [headers]
+    for shard in manifest['shards']:
+        with open_shard(os.path.join(directory, shard['path'])) as file:
+            if manifest['format'] == 'csv':
+                reader = csv.reader(file)
+                next(reader, None)
+                rows.extend(reader)
+            else:
+                rows.extend(list(json.loads(line).values()) for line in file if line.strip())
+    return rows
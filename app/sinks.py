@@ -0,0 +1,324 @@
+import abc
+import csv
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+from collections import namedtuple
+from app.checkpoint import partial_filename
+from app.database import SqliteExport
+from app.formatting import format_value
+from app.metrics import metrics
+from app.shards import ShardedFile
+from app.snapshot import SnapshotBuilder
+
+QUEUED_ROWS = 1024
+XLSX_BATCH_SIZE = 500
+QUEUED_BATCHES = 8
+DONE = object()
+# Worker processes are forked from a server process that has already
+# imported openpyxl, so each workbook starts quickly. Both start methods
+# are safe with the fetch threads running, unlike a plain fork.
+START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+# Sent through every row sink when the export wants a checkpoint; each sink
+# reports where its output stands once it has written the rows before it.
+Mark = namedtuple('Mark', ['rows', 'rating_key'])
+
+
+def log_write_rate(filename, count, started):
+    elapsed = time.monotonic() - started
+    rate = count / elapsed if elapsed > 0 else 0
+    logging.info(
+        f"Wrote {count} rows to {filename} in {elapsed:.1f}s ({rate:.0f} rows/s)")
+
+
+class Sink(abc.ABC):
+    # Writes one output of a section on its own thread. (item, row, record)
+    # messages arrive through a bounded queue, so a slow output stalls the
+    # fetch stage instead of buffering the section in memory. File outputs
+    # are written to a partial file that replaces filename once complete.
+    format = None
+    atomic = True
+
+    def __init__(self, filename, headers, resumed=None) -> None:
+        self.filename = filename
+        self.partial = partial_filename(filename)
+        self.headers = headers
+        self.resumed = resumed
+        self.count = resumed['rows'] if resumed else 0
+        self.queue = queue.Queue(maxsize=QUEUED_ROWS)
+        self.error = None
+        self.completed = False
+        self.thread = None
+        self.marked = None
+        self.started = None
+
+    def start(self, marked):
+        # marked(format, mark, position) is called from the sink thread.
+        self.marked = marked
+        self.started = time.monotonic()
+        self.thread = threading.Thread(target=metrics.bind(self.run),
+                                       name=f"plexport-{self.format}", daemon=True)
+        self.thread.start()
+
+    def put(self, message):
+        while True:
+            if self.error is not None:
+                raise self.error
+            try:
+                self.queue.put(message, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def run(self):
+        completed = False
+        try:
+            self.open()
+            while True:
+                message = self.queue.get()
+                if message is DONE:
+                    completed = self.completed
+                    break
+                if isinstance(message, Mark):
+                    self.marked(self.format, message, self.sync())
+                    continue
+                with metrics.phase('write'):
+                    self.write(*message)
+                self.count += 1
+        except BaseException as e:
+            self.error = e
+        finally:
+            try:
+                self.close(completed and self.error is None)
+            except BaseException as e:
+                self.error = self.error or e
+
+    def finish(self, completed):
+        # Stops the sink after the queued messages. Only a completed sink
+        # replaces its output; an interrupted one leaves the partial file
+        # for --resume.
+        self.completed = completed
+        if self.error is None:
+            self.put(DONE)
+        self.thread.join()
+        if self.error is not None:
+            if completed:
+                raise self.error
+            logging.error(f"Writing {self.filename} failed: {self.error}")
+            return
+        if completed and self.atomic:
+            self.commit()
+            log_write_rate(self.filename, self.count, self.started)
+
+    def commit(self):
+        os.replace(self.partial, self.filename)
+
+    def open(self):
+        pass
+
+    @abc.abstractmethod
+    def write(self, item, row, record):
+        pass
+
+    def sync(self):
+        return None
+
+    def close(self, completed):
+        pass
+
+
+class TextSink(Sink):
+    # Line based outputs resume by truncating the partial file back to the
+    # byte offset recorded with the checkpoint. With an output (see
+    # app.shards) they are written as compressed shards with a manifest
+    # instead, and the checkpoint position records the shards.
+    def __init__(self, filename, headers, resumed=None, output=None) -> None:
+        super().__init__(filename, headers, resumed)
+        self.output = output
+
+    def open(self):
+        if self.output is not None:
+            self.file = ShardedFile(self.filename, self.format, self.headers, self.output, self.write_header,
+                                    self.resumed['positions'][self.format] if self.resumed else None)
+            return
+        if self.resumed:
+            os.truncate(self.partial, self.resumed['positions'][self.format])
+        self.file = open(self.partial, mode='a' if self.resumed else 'w',
+                         newline='', encoding='utf-8')
+
+    def write_header(self):
+        pass
+
+    def write(self, item, row, record):
+        self.write_row(row)
+        if self.output is not None:
+            self.file.end_row(row)
+
+    @abc.abstractmethod
+    def write_row(self, row):
+        pass
+
+    def sync(self):
+        if self.output is not None:
+            return self.file.sync()
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return self.file.tell()
+
+    def close(self, completed):
+        self.file.close()
+
+    def commit(self):
+        if self.output is not None:
+            self.file.commit()
+        else:
+            super().commit()
+
+
+class CsvSink(TextSink):
+    format = 'csv'
+
+    def open(self):
+        super().open()
+        self.writer = csv.writer(self.file)
+        if not self.resumed and self.output is None:
+            self.write_header()
+
+    def write_header(self):
+        self.writer.writerow(self.headers)
+
+    def write_row(self, row):
+        self.writer.writerow([format_value(value) for value in row])
+
+
+class JsonlSink(TextSink):
+    # One JSON object per row, keyed by the column headers.
+    format = 'jsonl'
+
+    def write_row(self, row):
+        self.file.write(json.dumps(dict(zip(self.headers, [format_value(value) for value in row])),
+                                   ensure_ascii=False) + '\n')
+
+
+def write_workbook(filename, headers, previous_rows, batches):
+    # Runs in a worker process. The parent decides when an export stops,
+    # so Ctrl + C is left to it and the workbook is always saved.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    from openpyxl import Workbook
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    ws.append(headers)
+    for row in previous_rows:
+        ws.append(row)
+    while True:
+        batch = batches.get()
+        if batch is None:
+            break
+        for row in batch:
+            ws.append(row)
+    wb.save(filename)
+
+
+class XlsxSink(Sink):
+    # Building worksheet XML is the slowest part of an export, so rows are
+    # handed in batches to a worker process that owns the workbook. A
+    # workbook can't be appended to; resuming copies the rows of the
+    # partial workbook up to the checkpoint into a new one.
+    format = 'xlsx'
+
+    def open(self):
+        context = multiprocessing.get_context(START_METHOD)
+        if START_METHOD == 'forkserver':
+            context.set_forkserver_preload(['app.sinks', 'openpyxl'])
+        self.batch = []
+        self.batches = context.Queue(maxsize=QUEUED_BATCHES)
+        previous_rows = self.resumed['previous_rows'] if self.resumed else []
+        self.process = context.Process(target=write_workbook, name="plexport-xlsx",
+                                       args=(self.partial, self.headers, previous_rows, self.batches),
+                                       daemon=True)
+        self.process.start()
+
+    def write(self, item, row, record):
+        self.batch.append(row)
+        if len(self.batch) >= XLSX_BATCH_SIZE:
+            self.send(self.batch)
+
+    def sync(self):
+        # Rows before a mark only need to reach the worker; it saves them
+        # when the export ends, completed or not.
+        if self.batch:
+            self.send(self.batch)
+        return None
+
+    def send(self, message):
+        # None tells the worker to save the workbook.
+        while True:
+            if not self.process.is_alive():
+                raise RuntimeError(
+                    f"The worker writing {self.partial} exited with code {self.process.exitcode}")
+            try:
+                self.batches.put(message, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        self.batch = []
+
+    def close(self, completed):
+        if self.batch:
+            self.send(self.batch)
+        self.send(None)
+        self.process.join()
+        if self.process.exitcode != 0:
+            raise RuntimeError(
+                f"The worker writing {self.partial} exited with code {self.process.exitcode}")
+
+
+class SnapshotSink(Sink):
+    # Collects the section into a columnar snapshot (see app.snapshot) and
+    # saves it when the export ends, completed or not, like a workbook.
+    format = 'snapshot'
+
+    def open(self):
+        self.builder = SnapshotBuilder(self.headers)
+        for row in self.resumed['previous_rows'] if self.resumed else []:
+            self.builder.append(row)
+
+    def write(self, item, row, record):
+        self.builder.append(row)
+
+    def close(self, completed):
+        snapshot = self.builder.build()
+        with metrics.phase('write'):
+            snapshot.save(self.partial)
+        logging.debug(
+            f"Snapshot of {self.filename}: {len(snapshot)} rows in {snapshot.nbytes() / 1024 ** 2:.1f} MiB")
+
+
+class SqliteSink(Sink):
+    # Upserts records into the shared database. Records are None for items
+    # the database already holds at the same updatedAt. Exports that don't
+    # list the whole section (resumed or filtered) leave missing items in
+    # place.
+    format = 'sqlite'
+    atomic = False
+
+    def __init__(self, filename, headers, resumed=None, section=None, item_type=None,
+                 delete_missing=True) -> None:
+        super().__init__(filename, headers, resumed)
+        self.db = SqliteExport(filename, section, item_type, check_same_thread=False)
+        self.delete_missing = delete_missing
+
+    def is_current(self, item, counts=None):
+        return self.db.is_current(item, counts)
+
+    def write(self, item, row, record):
+        self.db.write(item, record)
+
+    def close(self, completed):
+        self.db.close(delete_missing=completed and self.delete_missing)
@@ -0,0 +1,295 @@
+import datetime
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+MAGIC = b'PLXSNAP1'
+ALIGNMENT = 8
+NULL_INT = -2 ** 63
+NULL_CODE = -1
+TYPECODES = {'int': 'q', 'float': 'd', 'date': 'q', 'category': 'i'}
+NULLS = {'int': NULL_INT, 'float': math.nan, 'date': NULL_INT, 'category': NULL_CODE}
+# Strings are interned while at most this share of a column's values is
+# distinct; past it (titles, summaries, paths) they are stored as they come.
+INTERN_RATIO = 0.5
+INTERN_CHECK = 1024
+
+
+def value_kind(value):
+    if isinstance(value, datetime.datetime):
+        return 'date'
+    if isinstance(value, (bool, int)):
+        return 'int'
+    if isinstance(value, float):
+        return 'float'
+    return 'category'
+
+
+def aligned(size):
+    return -(-size // ALIGNMENT) * ALIGNMENT
+
+
+class Strings:
+    # The distinct values of a category column as one UTF-8 buffer and the
+    # offsets between them, in memory or mapped from a snapshot file.
+    def __init__(self, offsets=None, data=None) -> None:
+        self.offsets = offsets if offsets is not None else array('q', [0])
+        self.data = data if data is not None else bytearray()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        return bytes(self.data[self.offsets[index]:self.offsets[index + 1]]).decode('utf-8')
+
+    def append(self, value):
+        self.data += value.encode('utf-8')
+        self.offsets.append(len(self.data))
+
+    def nbytes(self):
+        return nbytes(self.offsets) + nbytes(self.data)
+
+
+def nbytes(buffer):
+    return buffer.nbytes if isinstance(buffer, memoryview) else len(buffer) * getattr(buffer, 'itemsize', 1)
+
+
+class ColumnBuilder:
+    # One column of a snapshot being built. Numbers live in typed arrays,
+    # dates as epoch seconds and strings as codes into the column's
+    # Strings, so repeated genres, codecs or containers are stored once.
+    # The kind follows the values: a column starts out empty, ints widen to
+    # floats and any other mix falls back to strings. Widening is lossy:
+    # ints read back from a float column as floats (3.0) and every value of
+    # a string column as its str() ('3').
+    def __init__(self) -> None:
+        self.kind = 'empty'
+        self.count = 0
+        self.data = None
+        self.strings = None
+        self.codes = None
+
+    def append(self, value):
+        self.count += 1
+        if value is None:
+            if self.data is not None:
+                self.data.append(NULLS[self.kind])
+            return
+        kind = value_kind(value)
+        if kind != self.kind:
+            kind = self.convert(kind)
+        self.data.append(self.encode(value))
+
+    def encode(self, value):
+        kind = self.kind
+        if kind == 'date':
+            return int(value.timestamp())
+        if kind != 'category':
+            return value
+        if not isinstance(value, str):
+            value = str(value)
+        codes = self.codes
+        if codes is not None:
+            code = codes.get(value)
+            if code is not None:
+                return code
+            code = codes[value] = len(self.strings)
+            if len(codes) % INTERN_CHECK == 0 and len(codes) > self.count * INTERN_RATIO:
+                self.codes = None
+        else:
+            code = len(self.strings)
+        self.strings.append(value)
+        return code
+
+    def convert(self, kind):
+        # Strings take any value as is; only a narrower column is rebuilt.
+        if self.kind == 'float' and kind == 'int':
+            return 'float'
+        if self.kind == 'category':
+            return 'category'
+        if self.data is not None:
+            previous = list(decoded(self.kind, self.data, self.strings))
+        else:
+            previous = [None] * (self.count - 1)
+        if self.kind == 'int' and kind == 'float':
+            self.kind = 'float'
+        elif self.kind == 'empty':
+            self.kind = kind
+        else:
+            self.kind = 'category'
+        self.data = array(TYPECODES[self.kind])
+        if self.kind == 'category':
+            self.strings = Strings()
+            self.codes = {}
+        for value in previous:
+            self.data.append(NULLS[self.kind] if value is None else self.encode(value))
+        return self.kind
+
+
+def decoded(kind, data, strings):
+    # Yields the values of a column with None for missing ones.
+    if kind == 'int':
+        return (None if value == NULL_INT else value for value in data)
+    if kind == 'float':
+        return (None if math.isnan(value) else value for value in data)
+    if kind == 'date':
+        return (None if value == NULL_INT else datetime.datetime.fromtimestamp(value) for value in data)
+    if kind == 'category':
+        # Small dictionaries are decoded once, large ones value by value.
+        values = list(strings) if len(strings) <= len(data) * INTERN_RATIO else strings
+        return (None if code == NULL_CODE else values[code] for code in data)
+    return iter(())
+
+
+class SnapshotBuilder:
+    def __init__(self, headers) -> None:
+        self.headers = list(headers)
+        self.columns = [ColumnBuilder() for _ in self.headers]
+        self.count = 0
+
+    def append(self, row):
+        for column, value in zip(self.columns, row):
+            column.append(value)
+        self.count += 1
+
+    def build(self):
+        return Snapshot(self.headers, self.count, [column.kind for column in self.columns],
+                        [column.data for column in self.columns], [column.strings for column in self.columns])
+
+
+class Snapshot:
+    # Columnar copy of an exported section: the rows the writers take, kept
+    # in a few flat buffers per column instead of one object graph per item.
+    # Writers consume it through rows(); analysis can use data() and
+    # categories() directly, e.g. with numpy.frombuffer. Loaded snapshots
+    # are memory mapped, so only the pages a reader touches are read.
+    def __init__(self, headers, count, kinds, data, strings, mapped=None) -> None:
+        self.headers = list(headers)
+        self.count = count
+        self.kinds = kinds
+        self.columns = data
+        self.strings = strings
+        self.mapped = mapped
+
+    def __len__(self):
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close()
+
+    def data(self, header):
+        # The array or memoryview behind a column: int64 for ints and epoch
+        # dates (NULL_INT when missing), float64 for floats (NaN when
+        # missing) and int32 codes into categories() (NULL_CODE when
+        # missing). None for columns without any value.
+        return self.columns[self.headers.index(header)]
+
+    def categories(self, header):
+        strings = self.strings[self.headers.index(header)]
+        return list(strings) if strings is not None else []
+
+    def column(self, header):
+        index = self.headers.index(header)
+        if self.kinds[index] == 'empty':
+            return iter([None] * self.count)
+        return decoded(self.kinds[index], self.columns[index], self.strings[index])
+
+    def rows(self, limit=None):
+        count = self.count if limit is None else min(limit, self.count)
+        columns = [self.column(header) for header in self.headers]
+        for _ in range(count):
+            yield tuple([next(column) for column in columns])
+
+    def nbytes(self):
+        return sum(nbytes(data) for data in self.columns if data is not None) + \
+            sum(strings.nbytes() for strings in self.strings if strings is not None)
+
+    def save(self, path):
+        buffers = []
+        offset = 0
+
+        def add(buffer):
+            nonlocal offset
+            buffer = bytes(buffer)
+            buffers.append(buffer + b'\0' * (aligned(len(buffer)) - len(buffer)))
+            entry = [offset, len(buffer)]
+            offset += aligned(len(buffer))
+            return entry
+
+        columns = []
+        for kind, data, strings in zip(self.kinds, self.columns, self.strings):
+            entry = {'kind': kind}
+            if kind != 'empty':
+                entry['data'] = add(data)
+            if kind == 'category':
+                entry['offsets'] = add(strings.offsets)
+                entry['strings'] = add(strings.data)
+            columns.append(entry)
+        header = json.dumps({'headers': self.headers, 'rows': self.count, 'byteorder': sys.byteorder,
+                             'columns': columns}).encode('utf-8')
+        start = aligned(len(MAGIC) + 8 + len(header))
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'wb') as file:
+            file.write(MAGIC + struct.pack('<Q', len(header)) + header)
+            file.write(b'\0' * (start - file.tell()))
+            for buffer in buffers:
+                file.write(buffer)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as file:
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if mapped[:len(MAGIC)] != MAGIC:
+            mapped.close()
+            raise ValueError(f"{path} is not a plexport snapshot")
+        length, = struct.unpack_from('<Q', mapped, len(MAGIC))
+        header = json.loads(mapped[len(MAGIC) + 8:len(MAGIC) + 8 + length])
+        start = aligned(len(MAGIC) + 8 + length)
+        view = memoryview(mapped)
+        swap = header['byteorder'] != sys.byteorder
+
+        def buffer(entry, typecode):
+            offset, size = entry
+            data = view[start + offset:start + offset + size]
+            if not swap:
+                return data.cast(typecode)
+            # Snapshots written on a machine of the other byte order are
+            # copied instead of mapped.
+            data = array(typecode, bytes(data))
+            data.byteswap()
+            return data
+
+        kinds, data, strings = [], [], []
+        for entry in header['columns']:
+            kind = entry['kind']
+            kinds.append(kind)
+            data.append(buffer(entry['data'], TYPECODES[kind])
+                        if kind != 'empty' else None)
+            strings.append(Strings(buffer(entry['offsets'], 'q'), buffer(entry['strings'], 'B'))
+                           if kind == 'category' else None)
+        return cls(header['headers'], header['rows'], kinds, data, strings, mapped=(mapped, view))
+
+    def close(self):
+        # Releases the mapping of a loaded snapshot; its columns can't be
+        # read afterwards.
+        if self.mapped is None:
+            return
+        mapped, view = self.mapped
+        buffers = self.columns + [buffer for strings in self.strings if strings is not None
+                                  for buffer in (strings.offsets, strings.data)]
+        for buffer in buffers:
+            if isinstance(buffer, memoryview):
+                buffer.release()
+        self.columns = [None] * len(self.columns)
+        self.strings = [None] * len(self.strings)
+        view.release()
+        mapped.close()
+        self.mapped = None
@@ -0,0 +1,153 @@
+import csv
+import hashlib
+import json
+import os
+import re
+from app.counts import listing_counts
+from app.formatting import format_value
+from app.shards import MANIFEST_SUFFIX, read_sharded_rows
+
+INTEGRAL_FLOAT = re.compile(r'^-?\d+\.0$')
+
+
+def timestamp(value):
+    return int(value.timestamp()) if value else None
+
+
+def item_version(item, counts=None):
+    # What cached child counts and reused rows of an item are valid for.
+    # Adding or removing episodes or tracks doesn't always change the
+    # parent's updatedAt, so its child counts are part of it: the
+    # listing's childCount/leafCount unless counts are given.
+    updated_at = timestamp(item.updatedAt)
+    counts = listing_counts(item) if counts is None else counts
+    if updated_at is None or counts is None:
+        return updated_at
+    return ':'.join('' if value is None else str(value) for value in (updated_at,) + counts)
+
+
+def normalize(value):
+    # xlsx reads 700.0 back as 700 while csv keeps '700.0'.
+    if value is None:
+        return ''
+    value = str(format_value(value))
+    return value[:-2] if INTEGRAL_FLOAT.match(value) else value
+
+
+def row_hash(row):
+    # Rows are hashed in the form they are read back from disk, so values
+    # written by this run and values loaded from the previous output match.
+    normalized = [normalize(value) for value in row]
+    return hashlib.sha1(json.dumps(normalized).encode('utf-8')).hexdigest()
+
+
+def read_rows(filename, format):
+    # Returns every row of a previous export, including the header row.
+    if not os.path.exists(filename):
+        return []
+    if filename.endswith(MANIFEST_SUFFIX):
+        return read_sharded_rows(filename)
+    if format == "csv":
+        with open(filename, newline='', encoding='utf-8') as file:
+            return list(csv.reader(file))
+    if format == "jsonl":
+        with open(filename, encoding='utf-8') as file:
+            records = [json.loads(line) for line in file if line.strip()]
+        return [list(records[0])] + [list(record.values()) for record in records] if records else []
+    if format == "snapshot":
+        from app.snapshot import Snapshot
+        with Snapshot.load(filename) as snapshot:
+            return [snapshot.headers] + [list(row) for row in snapshot.rows()]
+    if format == "xlsx":
+        from openpyxl import load_workbook
+        wb = load_workbook(filename, read_only=True)
+        try:
+            return [list(row) for row in wb.active.iter_rows(values_only=True)]
+        finally:
+            wb.close()
+    return []
+
+
+class SectionState:
+    # Tracks ratingKey -> [item version, row hash] for one exported section so
+    # unchanged items can reuse their row from the previous output.
+    def __init__(self, path, entries, rows) -> None:
+        self.path = path
+        self.entries = entries
+        self.rows = rows
+        self.seen = {}
+        self.reused = 0
+        self.journal = None
+
+    @classmethod
+    def load(cls, path, filename, format, headers):
+        entries = {}
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as file:
+                entries = json.load(file)
+        rows = read_rows(filename, format) if entries else []
+        if not rows or list(rows[0]) != list(headers):
+            # A different column selection can't reuse previous rows.
+            return cls(path, {}, {})
+        return cls(path, entries, {row_hash(row): row for row in rows[1:]})
+
+    def cached_row(self, item, version):
+        entry = self.entries.get(str(item.ratingKey))
+        if entry is None or version is None or entry[0] != version:
+            return None
+        return self.rows.get(entry[1])
+
+    def previous_row(self, key):
+        entry = self.entries.get(key)
+        return self.rows.get(entry[1]) if entry else None
+
+    def keep(self, key):
+        # Carries over the entry of an unchanged item without the item.
+        self.add(key, self.entries[key])
+
+    def open_journal(self, resume_rows=0):
+        # Every recorded entry is also appended to a journal, so a resumed
+        # export recovers the entries of the rows it doesn't rebuild.
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        path = f"{self.path}.journal"
+        if resume_rows and os.path.exists(path):
+            with open(path, 'r+b') as file:
+                for _ in range(resume_rows):
+                    line = file.readline()
+                    if not line:
+                        break
+                    self.add(*json.loads(line))
+                file.truncate(file.tell())
+        self.journal = open(path, 'a' if resume_rows else 'w', encoding='utf-8')
+
+    def flush_journal(self):
+        if self.journal:
+            self.journal.flush()
+
+    def record(self, item, row, version):
+        key = str(item.ratingKey)
+        entry = [version, row_hash(row)]
+        self.add(key, entry)
+        if self.journal:
+            self.journal.write(json.dumps([key, entry]) + '\n')
+
+    def add(self, key, entry):
+        if self.entries.get(key) == entry:
+            self.reused += 1
+        self.seen[key] = entry
+
+    def save(self):
+        if self.journal:
+            self.journal.close()
+            os.remove(self.journal.name)
+            self.journal = None
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump(self.seen, file)
+        os.replace(temp_path, self.path)
+
+    def summary(self):
+        deleted = len(self.entries.keys() - self.seen.keys())
+        changed = len(self.seen) - self.reused
+        return f"{self.reused} unchanged, {changed} added or changed, {deleted} deleted"
@@ -0,0 +1,248 @@
+import csv
+import glob
+import io
+import json
+import logging
+import math
+import os
+import time
+import numpy
+from app.defaults import PAGE_SIZE, TOP
+from app.metrics import write_atomic
+from app.paging import iter_listing
+from app.snapshot import NULL_CODE, NULL_INT, Snapshot, SnapshotBuilder
+
+# One row per media part: every version and every part of an item, not
+# just the first part of the first version the export columns show.
+PART_HEADERS = ['rating_key', 'title', 'media_id', 'part_id', 'file', 'size', 'duration', 'bitrate',
+                'resolution', 'codec', 'container']
+# Listing type holding the media of each section type.
+LEAF_TYPES = {'movie': 1, 'show': 4, 'artist': 10}
+GROUPS = ['resolution', 'codec', 'container']
+PERCENTILES = [50, 90, 99]
+PARTS_SUFFIX = ' Parts.snapshot'
+
+
+def integer(value):
+    return int(value) if value not in (None, '') else None
+
+
+def part_title(element):
+    if element.get('grandparentTitle'):
+        return f"{element.get('grandparentTitle')} - {element.get('title')}"
+    year = element.get('year')
+    return f"{element.get('title')} ({year})" if year else element.get('title')
+
+
+def collect_parts(plex, section, page_size=PAGE_SIZE):
+    # Reads the media of a section from its leaf listing (movies, episodes
+    # or tracks) into a columnar snapshot, one row per part.
+    builder = SnapshotBuilder(PART_HEADERS)
+    for element in iter_listing(plex, section, LEAF_TYPES[section.type], page_size):
+        rating_key = integer(element.get('ratingKey'))
+        title = part_title(element)
+        for media in element.iter('Media'):
+            codec = media.get('videoCodec') or media.get('audioCodec')
+            for part in media.iter('Part'):
+                builder.append([rating_key, title, integer(media.get('id')), integer(part.get('id')),
+                                part.get('file'), integer(part.get('size')),
+                                integer(part.get('duration') or media.get('duration')),
+                                integer(media.get('bitrate')), media.get('videoResolution'), codec,
+                                part.get('container') or media.get('container')])
+    return builder.build()
+
+
+class NumpyColumns:
+    # Reads snapshot columns as numpy arrays over the snapshot buffers and
+    # aggregates them in vectorized passes.
+    def __init__(self, snapshot) -> None:
+        self.snapshot = snapshot
+
+    def numbers(self, header):
+        # float64 values with NaN for missing ones.
+        index = self.snapshot.headers.index(header)
+        kind, data = self.snapshot.kinds[index], self.snapshot.columns[index]
+        if kind in ('int', 'date'):
+            values = numpy.frombuffer(data, dtype=numpy.int64)
+            result = values.astype(numpy.float64)
+            result[values == NULL_INT] = numpy.nan
+            return result
+        if kind == 'float':
+            return numpy.frombuffer(data, dtype=numpy.float64)
+        return numpy.array([numpy.nan if value is None else float(value)
+                            for value in self.snapshot.column(header)], dtype=numpy.float64)
+
+    def codes(self, header):
+        # int32 category codes (NULL_CODE when missing) and their values.
+        index = self.snapshot.headers.index(header)
+        if self.snapshot.kinds[index] == 'category':
+            return numpy.frombuffer(self.snapshot.columns[index], dtype=numpy.int32), self.snapshot.categories(header)
+        values = [None if value is None else str(value) for value in self.snapshot.column(header)]
+        categories = sorted({value for value in values if value is not None})
+        lookup = {value: code for code, value in enumerate(categories)}
+        return numpy.array([NULL_CODE if value is None else lookup[value] for value in values],
+                           dtype=numpy.int32), categories
+
+    def total(self, values):
+        return float(numpy.nansum(values))
+
+    def distinct(self, values):
+        return int(numpy.unique(values[~numpy.isnan(values)]).size)
+
+    def percentiles(self, values):
+        values = values[~numpy.isnan(values)]
+        if not values.size:
+            return None
+        return float(values.min()), [float(value) for value in numpy.percentile(values, PERCENTILES)], \
+            float(values.max())
+
+    def groups(self, codes, count, weights):
+        # (files, summed weights) per code, with missing values last.
+        shifted = numpy.where(codes == NULL_CODE, count, codes)
+        weights = numpy.nan_to_num(weights)
+        return numpy.bincount(shifted, minlength=count + 1).tolist(), \
+            numpy.bincount(shifted, weights=weights, minlength=count + 1).tolist()
+
+    def largest(self, values, n):
+        values = numpy.nan_to_num(values, nan=-1)
+        n = min(n, values.size)
+        if not n:
+            return []
+        top = numpy.argpartition(values, values.size - n)[values.size - n:]
+        return top[numpy.lexsort((top, -values[top]))].tolist()
+
+    def versions(self, items, media, sizes):
+        # Per item with several versions: (first row, versions, bytes beyond
+        # its largest version).
+        sizes = numpy.nan_to_num(sizes)
+        media_keys, first, inverse = numpy.unique(media, return_index=True, return_inverse=True)
+        media_bytes = numpy.bincount(inverse, weights=sizes)
+        item_keys, item_first, item_inverse, counts = numpy.unique(
+            items[first], return_index=True, return_inverse=True, return_counts=True)
+        largest = numpy.zeros(item_keys.size)
+        numpy.maximum.at(largest, item_inverse, media_bytes)
+        extra = numpy.bincount(item_inverse, weights=media_bytes) - largest
+        duplicated = numpy.flatnonzero(counts > 1)
+        return [(int(first[item_first[index]]), int(counts[index]), float(extra[index])) for index in duplicated]
+
+
+def summarize(snapshot, top=TOP):
+    # Aggregates the parts snapshot of one section.
+    columns = NumpyColumns(snapshot)
+    sizes = columns.numbers('size')
+    durations = columns.numbers('duration')
+    bitrates = columns.numbers('bitrate')
+    items = columns.numbers('rating_key')
+    media = columns.numbers('media_id')
+    total_bytes = columns.total(sizes)
+    report = {
+        'files': len(snapshot),
+        'items': columns.distinct(items),
+        'versions': columns.distinct(media),
+        'bytes': round(total_bytes),
+        'duration_hours': round(columns.total(durations) / 3600000, 2),
+        'bitrate_kbps': distribution(columns.percentiles(bitrates)),
+        'duration_minutes': distribution(columns.percentiles(durations), 60000),
+    }
+    for group in GROUPS:
+        codes, categories = columns.codes(group)
+        files, sums = columns.groups(codes, len(categories), sizes)
+        entries = [{'value': value, 'files': count, 'bytes': round(size),
+                    'share': round(size / total_bytes, 4) if total_bytes else 0}
+                   for value, count, size in zip(categories + [None], files, sums) if count]
+        report[f"by_{group}"] = sorted(entries, key=lambda entry: -entry['bytes'])
+    versions = sorted(columns.versions(items, media, sizes),
+                      key=lambda entry: (-entry[2], entry[0]))
+    largest = columns.largest(sizes, top)
+    title_rows = sorted({row for row, _, _ in versions[:top]} | set(largest))
+    titles = dict(zip(title_rows, row_values(snapshot, 'title', title_rows)))
+    report['duplicates'] = {
+        'items': len(versions),
+        'extra_versions': sum(count - 1 for _, count, _ in versions),
+        'extra_bytes': round(sum(extra for _, _, extra in versions)),
+        'top': [{'title': titles[row], 'versions': count, 'extra_bytes': round(extra)}
+                for row, count, extra in versions[:top]],
+    }
+    details = {header: dict(zip(largest, row_values(snapshot, header, largest)))
+               for header in ('file', 'resolution', 'codec')}
+    report['largest'] = [{'title': titles[row], 'file': details['file'][row], 'bytes': round(sizes[row]),
+                          'resolution': details['resolution'][row], 'codec': details['codec'][row]}
+                         for row in largest if not math.isnan(sizes[row])]
+    return report
+
+
+def row_values(snapshot, header, rows):
+    # Values of a few rows of a column. Strings are looked up by their code;
+    # other columns are decoded in one pass.
+    index = snapshot.headers.index(header)
+    if snapshot.kinds[index] == 'category':
+        codes, strings = snapshot.columns[index], snapshot.strings[index]
+        return [None if codes[row] == NULL_CODE else strings[codes[row]] for row in rows]
+    wanted = set(rows)
+    values = {}
+    for row, value in enumerate(snapshot.column(header)):
+        if row in wanted:
+            values[row] = value
+            if len(values) == len(wanted):
+                break
+    return [values.get(row) for row in rows]
+
+
+def distribution(result, scale=1):
+    if result is None:
+        return None
+    low, middle, high = result
+    entry = {'min': round(low / scale, 2)}
+    entry.update({f"p{q}": round(value / scale, 2) for q, value in zip(PERCENTILES, middle)})
+    entry['max'] = round(high / scale, 2)
+    return entry
+
+
+def stats_csv(reports):
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(['Section', 'Group', 'Value', 'Files', 'Bytes', 'Share'])
+    for title, report in reports.items():
+        writer.writerow([title, 'total', '', report['files'], report['bytes'], 1 if report['bytes'] else 0])
+        for group in GROUPS:
+            for entry in report[f"by_{group}"]:
+                writer.writerow([title, group, entry['value'] or '(unknown)', entry['files'], entry['bytes'],
+                                 entry['share']])
+    return output.getvalue()
+
+
+def write_reports(reports, export_dir, formats):
+    for format in formats:
+        filename = os.path.join(export_dir, f"stats.{format}")
+        write_atomic(filename, json.dumps(reports, indent=2) if format == 'json' else stats_csv(reports))
+        logging.info(f"Wrote media statistics to {filename}")
+
+
+def summarize_timed(title, snapshot, top):
+    started = time.perf_counter()
+    report = summarize(snapshot, top)
+    logging.info(f"Summarized {report['files']} files of {title} in {time.perf_counter() - started:.3f}s")
+    return report
+
+
+def section_stats(plex, sections, export_dir, top=TOP, page_size=PAGE_SIZE, save_parts=False):
+    reports = {}
+    for section in sections:
+        started = time.perf_counter()
+        snapshot = collect_parts(plex, section, page_size)
+        logging.info(
+            f"Read {len(snapshot)} files of {section.title} in {time.perf_counter() - started:.1f}s")
+        if save_parts:
+            snapshot.save(os.path.join(export_dir, f"{section.title}{PARTS_SUFFIX}"))
+        reports[section.title] = summarize_timed(section.title, snapshot, top)
+    return reports
+
+
+def saved_stats(export_dir, top=TOP):
+    # Summarizes the parts snapshots a previous run saved, without a server.
+    reports = {}
+    for filename in sorted(glob.glob(os.path.join(glob.escape(export_dir), f"*{PARTS_SUFFIX}"))):
+        title = os.path.basename(filename)[:-len(PARTS_SUFFIX)]
+        with Snapshot.load(filename) as snapshot:
+            reports[title] = summarize_timed(title, snapshot, top)
+    return reports
@@ -0,0 +1,333 @@
+import importlib.util
+import logging
+import threading
+import time
+from app.agent import resolve_ids
+from app.counts import build_album_index, build_artist_index, build_count_index
+from app.database import SqliteExport, item_record
+from app.defaults import DEBOUNCE, POLL_INTERVAL
+from app.paging import total_size
+from app.state import SectionState
+
+LIBRARY = 'com.plexapp.plugins.library'
+# Timeline states of an item that finished processing (1 when the section
+# has no metadata agent, 5 otherwise) and of a deleted item.
+CHANGED_STATES = (1, 5)
+DELETED_STATE = 9
+# A steady stream of changes still reaches the outputs this often.
+MAX_DELAY = 60.0
+FETCH_BATCH = 100
+WAIT = 0.5
+# Listing types polled per section type: the exported items and the leaves
+# whose changes (new episodes, tracks) update them.
+POLL_TYPES = {'movie': (1,), 'show': (2, 4), 'artist': (8, 10)}
+ITEM_TYPES = {'movie': 1, 'show': 2, 'artist': 8, 'track': 10}
+
+
+def no_mark(format, mark, position):
+    pass
+
+
+class Watcher:
+    # Keeps the exports of one server current after an initial incremental
+    # export. Library notifications, or updatedAt polling without them, are
+    # collected per section and debounced; each batch re-fetches only the
+    # changed items and rewrites the section outputs from the previous rows
+    # in the incremental state. Changes it can't place (a deleted episode,
+    # a renamed album in a track export, outputs without state) fall back
+    # to an incremental export of the section.
+    def __init__(self, export, formats, debounce=DEBOUNCE, poll_interval=POLL_INTERVAL) -> None:
+        self.export = export
+        self.plex = export.plex
+        self.formats = formats
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.sections = {}
+        self.lock = threading.Lock()
+        # Section key -> {ratingKey: deleted}
+        self.pending = {}
+        self.sweeps = set()
+        self.first = None
+        self.last = None
+        self.listener = None
+        self.listener_failed = False
+        # (section key, type) -> (latest updatedAt seen, ratingKeys updated then)
+        self.marks = {}
+        self.sizes = {}
+        # Section key -> when to export a section whose update failed again.
+        self.retries = {}
+
+    @property
+    def label(self):
+        return self.export.name or self.plex.friendlyName
+
+    def sync(self, sections=None):
+        self.export.export(self.formats, sections)
+        for section in self.export.sections():
+            if sections is None or section.key in sections:
+                self.sizes[section.key] = self.section_size(section)
+
+    def section_size(self, section):
+        item_type = ITEM_TYPES['track' if section.type == 'artist' and self.export.music == 'tracks'
+                               else section.type]
+        return total_size(self.plex, f"/library/sections/{section.key}/all?type={item_type}")
+
+    def run(self, stop):
+        self.sections = {section.key: section for section in self.export.sections()}
+        for section in self.sections.values():
+            for type in POLL_TYPES[section.type]:
+                self.marks[section.key, type] = self.latest_update(section, type)
+        self.listen()
+        next_poll = time.monotonic() + self.poll_interval
+        try:
+            while not stop.wait(WAIT):
+                if not self.listening() and time.monotonic() >= next_poll:
+                    try:
+                        self.poll()
+                    except Exception as e:
+                        logging.error(f"{self.label}: polling for changes failed: {e}")
+                    next_poll = time.monotonic() + self.poll_interval
+                batch, sweeps = self.take()
+                for key in sweeps:
+                    logging.info(
+                        f"{self.label}: re-exporting {self.sections[key].title}")
+                    try:
+                        self.sync({key})
+                    except Exception as e:
+                        self.retry(key, e)
+                for key, changes in batch.items():
+                    if key not in sweeps:
+                        try:
+                            self.apply(self.sections[key], changes)
+                        except Exception as e:
+                            self.retry(key, e)
+        finally:
+            if self.listener is not None and self.listener.is_alive():
+                self.listener.stop()
+
+    def listen(self):
+        if importlib.util.find_spec('websocket') is None:
+            logging.info(
+                f"{self.label}: install websocket-client for live notifications, "
+                f"polling every {self.poll_interval:.0f}s instead")
+            return
+        self.listener = self.plex.startAlertListener(
+            callback=self.alert, callbackError=self.alert_error)
+
+    def listening(self):
+        if self.listener is None or self.listener_failed:
+            return False
+        if not self.listener.is_alive():
+            logging.warning(
+                f"{self.label}: notifications stopped, polling every {self.poll_interval:.0f}s instead")
+            self.listener_failed = True
+            return False
+        return True
+
+    def alert_error(self, error):
+        self.listener_failed = True
+        logging.warning(
+            f"{self.label}: notifications failed, polling every {self.poll_interval:.0f}s instead: {error}")
+
+    def alert(self, data):
+        if data.get('type') != 'timeline':
+            return
+        for entry in data.get('TimelineEntry', []):
+            if entry.get('identifier') != LIBRARY:
+                continue
+            section_key = int(entry.get('sectionID') or -1)
+            state = entry.get('state')
+            if section_key in self.sections and (state in CHANGED_STATES or state == DELETED_STATE):
+                self.queue(section_key, int(entry['itemID']), deleted=state == DELETED_STATE)
+
+    def latest_update(self, section, type):
+        data = self.plex.query(f"/library/sections/{section.key}/all?type={type}&sort=updatedAt:desc"
+                               f"&X-Plex-Container-Start=0&X-Plex-Container-Size=1")
+        element = next(iter(data), None)
+        if element is None:
+            return 0, set()
+        return int(element.get('updatedAt') or 0), {int(element.get('ratingKey'))}
+
+    def poll(self):
+        # Items updated at the mark itself are listed again by the next poll,
+        # so the ones already queued are skipped.
+        for section in self.sections.values():
+            for type in POLL_TYPES[section.type]:
+                mark, queued = self.marks[section.key, type]
+                data = self.plex.query(
+                    f"/library/sections/{section.key}/all?type={type}&updatedAt>>={mark}")
+                changed = [(int(element.get('updatedAt') or 0), int(element.get('ratingKey')))
+                           for element in data]
+                for updated_at, rating_key in changed:
+                    if updated_at > mark or rating_key not in queued:
+                        self.queue(section.key, rating_key)
+                latest = max([mark] + [updated_at for updated_at, _ in changed])
+                self.marks[section.key, type] = (latest, {rating_key for updated_at, rating_key in changed
+                                                          if updated_at == latest} | (queued if latest == mark else set()))
+            # Deletions don't change updatedAt; a section whose size no longer
+            # matches its outputs is exported again.
+            with self.lock:
+                quiet = section.key not in self.pending
+            if quiet and self.section_size(section) != self.sizes.get(section.key):
+                with self.lock:
+                    self.sweeps.add(section.key)
+                    self.touch()
+
+    def queue(self, section_key, rating_key, deleted=False):
+        with self.lock:
+            self.pending.setdefault(section_key, {})[rating_key] = deleted
+            self.touch()
+
+    def touch(self):
+        now = time.monotonic()
+        self.first = self.first or now
+        self.last = now
+
+    def retry(self, section_key, error):
+        # Changes that couldn't be applied aren't dropped: the section is
+        # exported again once the poll interval has passed.
+        logging.error(f"{self.label}: updating {self.sections[section_key].title} failed, "
+                      f"re-exporting it in {self.poll_interval:.0f}s: {error}")
+        with self.lock:
+            self.retries[section_key] = time.monotonic() + self.poll_interval
+
+    def take(self):
+        # Hands out the pending changes once they have been quiet for the
+        # debounce delay, or have waited MAX_DELAY, and the sections due
+        # for a retry.
+        with self.lock:
+            now = time.monotonic()
+            due = {key for key, retry_at in self.retries.items() if retry_at <= now}
+            for key in due:
+                del self.retries[key]
+            if self.first is None or (now - self.last < self.debounce and now - self.first < MAX_DELAY):
+                return {}, due
+            batch, sweeps = self.pending, self.sweeps | due
+            self.pending, self.sweeps = {}, set()
+            self.first = self.last = None
+        return batch, sweeps
+
+    def fetch(self, rating_keys):
+        items = []
+        rating_keys = sorted(rating_keys)
+        for start in range(0, len(rating_keys), FETCH_BATCH):
+            keys = ','.join(str(key) for key in rating_keys[start:start + FETCH_BATCH])
+            items.extend(self.plex.fetchItems(
+                f"/library/metadata/{keys}?includeGuids=1"))
+        for item in items:
+            item._autoReload = False
+        return items
+
+    def apply(self, section, changes):
+        started = time.monotonic()
+        export = self.export
+        configured = export.configure_section(section, self.formats)
+        if configured is None:
+            return
+        item_type, output_title, row_formats = configured
+        states = {format: SectionState.load(export.get_state_filename(output_title, format),
+                                            export.get_output_filename(export.get_filename(output_title, format),
+                                                                       format),
+                                            format, export.headers())
+                  for format in row_formats}
+        db = SqliteExport(export.get_filename(output_title, "sqlite"),
+                          section, item_type) if "sqlite" in self.formats else None
+        try:
+            patched = self.patch(section, item_type, output_title, changes, states, db)
+        finally:
+            if db is not None:
+                db.close(delete_missing=False)
+        if not patched:
+            logging.info(
+                f"{self.label}: can't patch {output_title} in place, re-exporting it")
+            self.sync({section.key})
+            return
+        for format, state in states.items():
+            state.save()
+        logging.info(f"{self.label}: patched {output_title} in {time.monotonic() - started:.1f}s "
+                     f"({next(iter(states.values())).summary() if states else f'{len(changes)} changes'})")
+
+    def patch(self, section, item_type, output_title, changes, states, db):
+        # Returns False when the changes can't be applied to the outputs.
+        export = self.export
+        if any(not state.entries for state in states.values()):
+            return False
+        if states:
+            known = [int(key) for key in next(iter(states.values())).entries]
+        else:
+            known = list(db.updated_at)
+        known_keys = set(known)
+        deleted = {key for key, is_deleted in changes.items() if is_deleted}
+        if deleted - known_keys:
+            # A deleted child item; its parent is unknown.
+            return False
+        items = {}
+        parents = set()
+        for item in self.fetch(set(changes) - deleted):
+            if item.type == item_type:
+                items[item.ratingKey] = item
+            elif item_type == 'show' and item.type in ('season', 'episode'):
+                parents.add(item.parentRatingKey if item.type == 'season' else item.grandparentRatingKey)
+            elif item_type == 'artist' and item.type in ('album', 'track'):
+                parents.add(item.parentRatingKey if item.type == 'album' else item.grandparentRatingKey)
+            elif item_type == 'track' and item.type in ('artist', 'album'):
+                # Artist and album fields are copied into every track row.
+                return False
+        missing = parents - set(items)
+        if missing:
+            items.update((item.ratingKey, item) for item in self.fetch(missing)
+                         if item.type == item_type)
+        # Requested items the server no longer returns were deleted.
+        deleted |= (set(changes) - deleted - set(items)) & known_keys
+        deleted -= set(items)
+
+        export.child_counts = {}
+        export.counts = build_count_index(
+            self.plex, section, export.page_size) if export.bulk_counts and 'counts' in export.fields else None
+        export.albums = build_album_index(
+            self.plex, section, export.page_size) if 'album' in export.fields else None
+        export.artists = build_artist_index(
+            self.plex, section, export.page_size) if 'artist' in export.fields else None
+        export.ids = {key: resolve_ids(item) for key, item in items.items()} if 'ids' in export.fields else {}
+        rows = {}
+        for key, item in items.items():
+            data = export.item_data(item)
+            if states:
+                rows[key] = export.build_row(item, data)
+            if db is not None and not export.is_current(db, item):
+                db.write(item, item_record(section, item, *data.get('counts', (None, None)),
+                                           ids=data.get('ids')))
+        if db is not None and deleted:
+            db.delete(deleted)
+
+        # Rows keep their place; items new to the section go last until the
+        # next full export sorts them in.
+        order = [key for key in known if key not in deleted] + [key for key in items if key not in known_keys]
+        outputs = {}
+        for format, state in states.items():
+            output = outputs[format] = []
+            for key in order:
+                if key in rows:
+                    state.record(items[key], rows[key], export.item_version(items[key]))
+                    output.append(rows[key])
+                else:
+                    row = state.previous_row(str(key))
+                    if row is None:
+                        return False
+                    state.keep(str(key))
+                    output.append(row)
+        for format, output in outputs.items():
+            self.write(format, export.get_filename(output_title, format), output)
+        self.sizes[section.key] = len(order)
+        return True
+
+    def write(self, format, filename, rows):
+        sink = self.export.open_sink(format, filename)
+        sink.start(no_mark)
+        completed = False
+        try:
+            for row in rows:
+                sink.put((None, row, None))
+            completed = True
+        finally:
+            sink.finish(completed)
@@ -0,0 +1,517 @@
+import gzip
+import random
+import re
+import threading
+import time
+import xml.etree.ElementTree as ET
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+MOVIE, SHOW, SEASON, EPISODE, ARTIST, ALBUM, TRACK = 1, 2, 3, 4, 8, 9, 10
+KEY_BASE = 10 ** 8
+EPOCH = 1600000000
+
+SECTIONS = {
+    1: ('Movies', 'movie', MOVIE, (MOVIE,)),
+    2: ('TV Shows', 'show', SHOW, (SHOW, SEASON, EPISODE)),
+    3: ('Music', 'artist', ARTIST, (ARTIST, ALBUM, TRACK)),
+}
+GENRES = ['Action', 'Comedy', 'Drama', 'Horror', 'Documentary', 'Animation']
+RESOLUTIONS = ['sd', '720', '1080', '4k']
+CODECS = ['h264', 'hevc', 'mpeg4']
+CONTAINERS = ['mkv', 'mp4', 'avi']
+# Filter fields per libtype as the includeMeta=1 listing describes them.
+# Artists can't be filtered by genre, so that filter is checked by the
+# client instead.
+FIELDS = {
+    'movie': ['year', 'addedAt', 'updatedAt', 'genre', 'resolution', 'unwatched'],
+    'show': ['year', 'addedAt', 'updatedAt', 'genre', 'unwatched'],
+    'artist': ['addedAt', 'updatedAt'],
+    'track': ['year', 'addedAt', 'updatedAt', 'unwatched'],
+}
+FIELD_TYPES = {
+    'year': 'integer', 'addedAt': 'date', 'updatedAt': 'date', 'genre': 'tag',
+    'resolution': 'resolution', 'unwatched': 'boolean',
+}
+OPERATORS = {
+    'integer': ['=', '!=', '>>=', '<<='],
+    'date': ['<<=', '>>='],
+    'tag': ['=', '!='],
+    'resolution': ['=', '!='],
+    'boolean': ['=', '!='],
+}
+TYPE_NAMES = {MOVIE: 'movie', SHOW: 'show', ARTIST: 'artist', TRACK: 'track'}
+
+
+def rating_key(kind, index):
+    return kind * KEY_BASE + index
+
+
+def split_key(key):
+    return key // KEY_BASE, key % KEY_BASE
+
+
+class SyntheticLibrary:
+    # Deterministic movie, TV and music libraries generated on demand from
+    # ratingKeys, so libraries of any size cost no memory to serve.
+    def __init__(self, movies=1000, shows=100, seasons=3, episodes=10,
+                 artists=100, albums=3, tracks=10) -> None:
+        self.sizes = {
+            MOVIE: movies,
+            SHOW: shows,
+            SEASON: shows * seasons,
+            EPISODE: shows * seasons * episodes,
+            ARTIST: artists,
+            ALBUM: artists * albums,
+            TRACK: artists * albums * tracks,
+        }
+        self.seasons = seasons
+        self.episodes = episodes
+        self.albums = albums
+        self.tracks = tracks
+        # ratingKey -> updatedAt of items changed with FakePlexServer.touch.
+        self.updated = {}
+
+    @property
+    def item_count(self):
+        return self.sizes[MOVIE] + self.sizes[SHOW] + self.sizes[ARTIST]
+
+    def element(self, kind, index):
+        return getattr(self, f"_{kind}")(index)
+
+    def listing(self, kind, start, size):
+        total = self.sizes[kind]
+        return [self.element(kind, index) for index in range(start, min(start + size, total))], total
+
+    def children(self, key):
+        kind, index = split_key(key)
+        if kind == SHOW:
+            return SEASON, range(index * self.seasons, (index + 1) * self.seasons)
+        if kind == SEASON:
+            return EPISODE, range(index * self.episodes, (index + 1) * self.episodes)
+        if kind == ARTIST:
+            return ALBUM, range(index * self.albums, (index + 1) * self.albums)
+        if kind == ALBUM:
+            return TRACK, range(index * self.tracks, (index + 1) * self.tracks)
+        return None, range(0)
+
+    def leaves(self, key):
+        kind, index = split_key(key)
+        if kind == SHOW:
+            count = self.seasons * self.episodes
+            return EPISODE, range(index * count, (index + 1) * count)
+        if kind == ARTIST:
+            count = self.albums * self.tracks
+            return TRACK, range(index * count, (index + 1) * count)
+        return self.children(key)
+
+    def _base(self, tag, kind, index, type, title, section):
+        key = rating_key(kind, index)
+        suffix = '/children' if tag == 'Directory' else ''
+        return ET.Element(tag, {
+            'ratingKey': str(key),
+            'key': f"/library/metadata/{key}{suffix}",
+            'type': type,
+            'title': f"{title} {index}",
+            'librarySectionID': str(section),
+            'addedAt': str(EPOCH + index),
+            'updatedAt': str(self.updated.get(key, EPOCH + index)),
+        })
+
+    def _tags(self, element, tag, values):
+        for value in values:
+            ET.SubElement(element, tag, {'tag': value})
+
+    def _1(self, index):
+        element = self._base('Video', MOVIE, index, 'movie', 'Movie', 1)
+        element.attrib.update({
+            'year': str(1950 + index % 70),
+            'rating': str(round(5 + index % 50 / 10, 1)),
+            'summary': f"Synthetic movie number {index}.",
+            'duration': str(5400000 + index % 3600 * 1000),
+        })
+        if index % 3 == 0:
+            element.set('viewCount', '1')
+        media = ET.SubElement(element, 'Media', {
+            'id': str(index + 1),
+            'videoResolution': RESOLUTIONS[index % len(RESOLUTIONS)],
+            'videoCodec': CODECS[index % len(CODECS)],
+            'container': CONTAINERS[index % len(CONTAINERS)],
+            'bitrate': str(2000 + index % 20000),
+            'audioChannels': str(2 if index % 2 else 6),
+            'duration': element.attrib['duration'],
+        })
+        ET.SubElement(media, 'Part', {
+            'id': str(index + 1),
+            'file': f"/data/movies/Movie {index}.mkv",
+            'size': str(700 * 1024 ** 2 + index * 4096),
+            'duration': element.attrib['duration'],
+            'container': media.attrib['container'],
+        })
+        if index % 25 == 0:
+            # Every 25th movie also has a smaller second version.
+            version = ET.SubElement(element, 'Media', {
+                'id': str(KEY_BASE + index), 'videoResolution': '720', 'videoCodec': 'h264',
+                'container': 'mp4', 'bitrate': '1500', 'audioChannels': '2',
+                'duration': element.attrib['duration']})
+            ET.SubElement(version, 'Part', {
+                'id': str(KEY_BASE + index), 'file': f"/data/movies/Movie {index} - 720p.mp4",
+                'size': str(300 * 1024 ** 2), 'duration': element.attrib['duration'], 'container': 'mp4'})
+        if index % 2:
+            # Odd movies use the new Plex agent and list their external ids.
+            element.set('guid', f"plex://movie/{index:024x}")
+            for guid in (f"imdb://tt{index:07d}", f"tmdb://{index + 1}"):
+                ET.SubElement(element, 'Guid', {'id': guid})
+        else:
+            element.set(
+                'guid', f"com.plexapp.agents.imdb://tt{index:07d}?lang=en")
+        self._tags(element, 'Genre', GENRES[index % 4:index % 4 + 2])
+        self._tags(element, 'Director', [f"Director {index % 500}"])
+        self._tags(element, 'Writer', [f"Writer {index % 700}"])
+        self._tags(element, 'Role', [f"Actor {(index + n) % 2000}" for n in range(3)])
+        return element
+
+    def _2(self, index):
+        element = self._base('Directory', SHOW, index, 'show', 'Show', 2)
+        element.attrib.update({
+            'guid': f"com.plexapp.agents.thetvdb://{70000 + index}?lang=en",
+            'year': str(1990 + index % 30),
+            'rating': '8.0',
+            'summary': f"Synthetic show number {index}.",
+            'childCount': str(self.seasons),
+            'leafCount': str(self.seasons * self.episodes),
+            'viewedLeafCount': str(index % 4 * self.episodes),
+        })
+        self._tags(element, 'Genre', GENRES[index % 5:index % 5 + 1])
+        return element
+
+    def _3(self, index):
+        element = self._base('Directory', SEASON, index, 'season', 'Season', 2)
+        show = index // self.seasons
+        element.attrib.update({
+            'parentRatingKey': str(rating_key(SHOW, show)),
+            'index': str(index % self.seasons + 1),
+            'leafCount': str(self.episodes),
+        })
+        return element
+
+    def _4(self, index):
+        element = self._base('Video', EPISODE, index, 'episode', 'Episode', 2)
+        season = index // self.episodes
+        element.attrib.update({
+            'parentRatingKey': str(rating_key(SEASON, season)),
+            'grandparentRatingKey': str(rating_key(SHOW, season // self.seasons)),
+            'index': str(index % self.episodes + 1),
+            'duration': '1800000',
+        })
+        media = ET.SubElement(element, 'Media', {
+            'id': str(index + 1), 'videoResolution': RESOLUTIONS[index % len(RESOLUTIONS)],
+            'videoCodec': CODECS[index % len(CODECS)], 'container': 'mkv',
+            'bitrate': str(1000 + index % 5000), 'duration': '1800000'})
+        ET.SubElement(media, 'Part', {
+            'id': str(index + 1), 'file': f"/data/tv/Episode {index}.mkv",
+            'size': str(200 * 1024 ** 2 + index * 2048), 'duration': '1800000', 'container': 'mkv'})
+        return element
+
+    def _8(self, index):
+        element = self._base('Directory', ARTIST, index, 'artist', 'Artist', 3)
+        element.attrib.update({
+            'guid': f"com.plexapp.agents.lastfm://Artist%20{index}?lang=en",
+            'summary': f"Synthetic artist number {index}.",
+        })
+        self._tags(element, 'Genre', GENRES[index % 6:index % 6 + 1])
+        return element
+
+    def _9(self, index):
+        element = self._base('Directory', ALBUM, index, 'album', 'Album', 3)
+        artist = index // self.albums
+        element.attrib.update({
+            'parentRatingKey': str(rating_key(ARTIST, artist)),
+            'parentTitle': f"Artist {artist}",
+            'year': str(1970 + index % 50),
+            'leafCount': str(self.tracks),
+        })
+        return element
+
+    def _10(self, index):
+        element = self._base('Track', TRACK, index, 'track', 'Track', 3)
+        album = index // self.tracks
+        artist = album // self.albums
+        element.attrib.update({
+            'parentRatingKey': str(rating_key(ALBUM, album)),
+            'grandparentRatingKey': str(rating_key(ARTIST, artist)),
+            'parentTitle': f"Album {album}",
+            'grandparentTitle': f"Artist {artist}",
+            'index': str(index % self.tracks + 1),
+            'duration': str(180000 + index % 120 * 1000),
+        })
+        if index % 2 == 0:
+            element.set('viewCount', str(index % 5 + 1))
+        media = ET.SubElement(element, 'Media', {
+            'id': str(index + 1),
+            'audioCodec': 'flac' if index % 3 else 'mp3',
+            'bitrate': str(320 + index % 700),
+            'container': 'flac' if index % 3 else 'mp3',
+            'duration': element.attrib['duration'],
+        })
+        ET.SubElement(media, 'Part', {
+            'id': str(index + 1),
+            'file': f"/data/music/Track {index}.flac",
+            'size': str(8 * 1024 ** 2 + index * 1024),
+            'duration': element.attrib['duration'],
+        })
+        return element
+
+
+class HTTPServer(ThreadingHTTPServer):
+    # The socketserver default backlog of 5 drops connections when many
+    # clients connect at once.
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+class FakePlexServer:
+    # Serves a SyntheticLibrary over the subset of the Plex XML API used by
+    # plexport, with optional per-request latency and request accounting.
+    # With compress, responses are gzipped for clients that accept it like
+    # Plex does; on localhost that only adds CPU, so it is off by default. A
+    # share of requests can be failed with 503 to exercise retries.
+    def __init__(self, library, latency=0.0, host='127.0.0.1', port=0, name='Fake Plex', compress=False,
+                 error_rate=0.0) -> None:
+        self.library = library
+        self.name = name
+        self.latency = latency
+        self.compress = compress
+        self.error_rate = error_rate
+        self.random = random.Random(0)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes = 0
+        self.httpd = HTTPServer((host, port), self.handler())
+        self.thread = None
+        self.filtered = {}
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def touch(self, kind, index, updated_at=None):
+        # Marks an item as changed, as a metadata refresh would.
+        self.library.updated[rating_key(kind, index)] = updated_at or int(time.time())
+        self.filtered = {}
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.bytes = 0
+
+    def record(self, size):
+        with self.lock:
+            self.requests += 1
+            self.bytes += size
+
+    def handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body go out in separate writes; with Nagle's
+            # algorithm on, each response waits for a delayed ACK.
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if server.latency:
+                    time.sleep(server.latency)
+                url = urlsplit(self.path)
+                params = dict(parse_qsl(url.query))
+                params.update({name: value for name, value in self.headers.items()
+                               if name.lower().startswith('x-plex-container')})
+                container = server.route(url.path.rstrip('/') or '/', params)
+                with server.lock:
+                    failed = server.error_rate and server.random.random() < server.error_rate
+                if failed:
+                    body = b'Service Unavailable'
+                    self.send_response(503)
+                elif container is None:
+                    body = b'Not Found'
+                    self.send_response(404)
+                else:
+                    body = ET.tostring(container, encoding='utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/xml;charset=utf-8')
+                    if server.compress and 'gzip' in self.headers.get('Accept-Encoding', ''):
+                        # The fastest level keeps the server from skewing
+                        # client timings.
+                        body = gzip.compress(body, compresslevel=1)
+                        self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                server.record(len(body))
+
+        return Handler
+
+    def route(self, path, params):
+        library = self.library
+        start = int(params.get('X-Plex-Container-Start', 0))
+        size = int(params.get('X-Plex-Container-Size', 100))
+        if path == '/':
+            return ET.Element('MediaContainer', {
+                'machineIdentifier': re.sub(r'\W+', '-', self.name.lower()),
+                'friendlyName': self.name,
+                'version': '1.40.0.0',
+                'platform': 'Linux',
+                'size': '0',
+            })
+        if path == '/library':
+            return ET.Element('MediaContainer', {'title1': 'Plex Library', 'size': '0'})
+        if path == '/library/sections':
+            container = ET.Element(
+                'MediaContainer', {'size': str(len(SECTIONS))})
+            for key, (title, type, _, _) in SECTIONS.items():
+                ET.SubElement(container, 'Directory', {
+                    'key': str(key), 'type': type, 'title': title, 'agent': 'tv.plex.agents.none',
+                    'scanner': 'Plex Scanner', 'language': 'en', 'uuid': f"fake-{key}",
+                    'updatedAt': str(EPOCH), 'createdAt': str(EPOCH),
+                })
+            return container
+        match = re.fullmatch(r'/library/sections/(\d+)/(all|collections|genre|resolution)', path)
+        if match:
+            section = SECTIONS.get(int(match.group(1)))
+            if section is None:
+                return None
+            if params.get('includeMeta') == '1':
+                return self.meta(int(match.group(1)), section if match.group(2) == 'all' else None)
+            if match.group(2) == 'collections':
+                return self.container([], 0, start)
+            if match.group(2) != 'all':
+                return self.choices(match.group(2))
+            kind = int(params.get('type', section[2]))
+            if kind not in section[3]:
+                return self.container([], 0, start)
+            filters = {name.split('.')[-1]: value for name, value in params.items()
+                       if name.split('.')[-1].rstrip('<>') in FIELD_TYPES}
+            sort = params.get('sort')
+            if filters or sort:
+                indexes = self.filter(kind, filters, sort)
+                elements = [library.element(kind, index) for index in indexes[start:start + size]]
+                total = len(indexes)
+            else:
+                elements, total = library.listing(kind, start, size)
+            if params.get('includeGuids') != '1':
+                for element in elements:
+                    for guid in element.findall('Guid'):
+                        element.remove(guid)
+            return self.container(elements, total, start, int(match.group(1)))
+        match = re.fullmatch(r'/library/metadata/(\d+(?:,\d+)+)', path)
+        if match:
+            elements = []
+            for key in map(int, match.group(1).split(',')):
+                kind, index = split_key(key)
+                if kind in library.sizes and index < library.sizes[kind]:
+                    elements.append(library.element(kind, index))
+            return self.container(elements, len(elements), 0)
+        match = re.fullmatch(r'/library/metadata/(\d+)(/children|/allLeaves)?', path)
+        if match:
+            key = int(match.group(1))
+            kind, index = split_key(key)
+            if kind not in library.sizes or index >= library.sizes[kind]:
+                return None
+            if match.group(2) is None:
+                return self.container([library.element(kind, index)], 1, 0)
+            if match.group(2) == '/children':
+                kind, indexes = library.children(key)
+            else:
+                kind, indexes = library.leaves(key)
+            page = indexes[start:start + size]
+            return self.container([library.element(kind, index) for index in page], len(indexes), start)
+        return None
+
+    def meta(self, key, section):
+        container = ET.Element('MediaContainer', {'size': '0'})
+        meta = ET.SubElement(container, 'Meta')
+        for type in [TYPE_NAMES[kind] for kind in section[3] if kind in TYPE_NAMES] if section else []:
+            element = ET.SubElement(meta, 'Type', {
+                'key': f"/library/sections/{key}/all?type={type}", 'type': type, 'title': type.title(),
+                'active': '1'})
+            for field in FIELDS[type]:
+                if FIELD_TYPES[field] in ('tag', 'resolution'):
+                    ET.SubElement(element, 'Filter', {
+                        'filter': field, 'filterType': 'string', 'key': f"/library/sections/{key}/{field}",
+                        'title': field.title(), 'type': 'filter'})
+                ET.SubElement(element, 'Field', {'key': field, 'title': field, 'type': FIELD_TYPES[field]})
+        for type, operators in OPERATORS.items():
+            element = ET.SubElement(meta, 'FieldType', {'type': type})
+            for operator in operators:
+                ET.SubElement(element, 'Operator', {'key': operator, 'title': operator})
+        return container
+
+    def choices(self, field):
+        values = GENRES if field == 'genre' else RESOLUTIONS
+        container = ET.Element('MediaContainer', {'size': str(len(values))})
+        for index, value in enumerate(values):
+            ET.SubElement(container, 'Directory', {
+                'key': str(index + 1) if field == 'genre' else value, 'title': value})
+        return container
+
+    def filter(self, kind, filters, sort=None):
+        # Indexes of the items matching the listing filters, computed once
+        # per filter combination. Only updatedAt sorts are supported.
+        key = (kind, tuple(sorted(filters.items())), sort)
+        if key not in self.filtered:
+            elements = [(index, self.library.element(kind, index)) for index in range(self.library.sizes[kind])]
+            if sort and sort.startswith('updatedAt'):
+                elements.sort(key=lambda entry: int(entry[1].get('updatedAt')),
+                              reverse=sort.endswith(':desc'))
+            self.filtered[key] = [index for index, element in elements if self.matches(element, filters)]
+        return self.filtered[key]
+
+    def matches(self, element, filters):
+        for name, value in filters.items():
+            field = name.rstrip('<>')
+            values = value.split(',')
+            if field in ('addedAt', 'updatedAt'):
+                if int(element.get(field)) < int(value):
+                    return False
+            elif field == 'year':
+                if element.get('year') not in values:
+                    return False
+            elif field == 'genre':
+                if not {str(GENRES.index(genre.get('tag')) + 1) for genre in element.findall('Genre')} & set(values):
+                    return False
+            elif field == 'resolution':
+                if not {media.get('videoResolution') for media in element.findall('Media')} & set(values):
+                    return False
+            elif field == 'unwatched':
+                if element.get('type') == 'show':
+                    watched = int(element.get('viewedLeafCount', 0)) >= int(element.get('leafCount', 0))
+                else:
+                    watched = int(element.get('viewCount', 0)) > 0
+                if watched == (value == '1'):
+                    return False
+        return True
+
+    def container(self, elements, total, start, section=None):
+        container = ET.Element('MediaContainer', {
+            'size': str(len(elements)),
+            'totalSize': str(total),
+            'offset': str(start),
+        })
+        if section is not None:
+            container.set('librarySectionID', str(section))
+        container.extend(elements)
+        return container
@@ -0,0 +1,165 @@
+import argparse
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from app.defaults import FORMATS
+from benchmarks.fake_plex import FakePlexServer, SyntheticLibrary
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODES = {
+    'bulk': {},
+    'per-item': {'bulk_counts': False},
+    'cached': {'bulk_counts': False, 'cache': True, 'prime': True},
+    'incremental': {'incremental': True, 'prime': True},
+    'async': {'bulk_counts': False, 'engine': 'async'},
+}
+
+
+def peak_rss_mib():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is KiB on Linux and bytes on macOS.
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+def run_child(options):
+    # Runs one export in this process and prints its timings as JSON.
+    from plexapi.server import PlexServer
+    from app.aio import AsyncEngine
+    from app.cache import MetadataCache
+    from app.export import Export
+    from app.session import new_session
+
+    logging.basicConfig(level=logging.WARNING)
+    os.environ['SECTIONS'] = 'all_sections'
+    plex = PlexServer(options['url'], 'benchmark',
+                      session=new_session(options['workers'] + 2))
+    mode = MODES[options['mode']]
+    cache = MetadataCache.for_server(plex, os.path.join(
+        options['export_dir'], 'cache')) if mode.get('cache') else None
+    engine = AsyncEngine(
+        plex, options['concurrency']) if mode.get('engine') == 'async' else None
+    export = Export(plex, options['export_dir'], workers=options['workers'],
+                    bulk_counts=mode.get('bulk_counts', True), page_size=options['page_size'],
+                    incremental=mode.get('incremental', False), cache=cache, engine=engine)
+    started = time.perf_counter()
+    export.export(formats=options['format'].split('+'))
+    wall = time.perf_counter() - started
+    if cache:
+        cache.close()
+    print(json.dumps({'wall': wall, 'peak_rss_mib': peak_rss_mib()}))
+
+
+def run_export(server, options):
+    server.reset()
+    result = subprocess.run([sys.executable, '-m', 'benchmarks.run', '--child', json.dumps(options)],
+                            cwd=ROOT, check=True, capture_output=True, text=True)
+    stats = json.loads(result.stdout.strip().splitlines()[-1])
+    stats.update({'requests': server.requests, 'bytes': server.bytes})
+    return stats
+
+
+def run_stats(server, args):
+    # Times the statistics report: reading the parts of every section, then
+    # summarizing them.
+    from plexapi.server import PlexServer
+    from app.session import new_session
+    from app.stats import collect_parts, summarize
+
+    plex = PlexServer(server.url, 'benchmark', session=new_session(2))
+    server.reset()
+    started = time.perf_counter()
+    snapshots = [collect_parts(plex, section, args.page_size) for section in plex.library.sections()]
+    parts = sum(len(snapshot) for snapshot in snapshots)
+    results = [{'format': 'stats', 'mode': 'collect', 'items': parts, 'wall': time.perf_counter() - started,
+                'requests': server.requests}]
+    started = time.perf_counter()
+    for snapshot in snapshots:
+        summarize(snapshot)
+    results.append({'format': 'stats', 'mode': 'summarize', 'items': parts, 'wall': time.perf_counter() - started,
+                    'requests': 0})
+    for stats in results:
+        print(f"{'stats':<14} {stats['mode']:<12} {stats['items']:>8} parts {stats['wall']:>8.2f}s "
+              f"{stats['items'] / stats['wall']:>9.0f} parts/s {stats['requests']:>7} requests")
+    return results
+
+
+def run_benchmarks(args):
+    library = SyntheticLibrary(movies=args.movies, shows=args.shows, seasons=args.seasons,
+                               episodes=args.episodes, artists=args.artists, albums=args.albums,
+                               tracks=args.tracks)
+    server = FakePlexServer(library, latency=args.latency / 1000,
+                            compress=args.gzip, error_rate=args.error_rate).start()
+    results = []
+    try:
+        if args.stats:
+            results.extend(run_stats(server, args))
+        for format in args.formats.split(',') if args.formats else []:
+            for mode in args.modes.split(','):
+                with tempfile.TemporaryDirectory() as export_dir:
+                    options = {'url': server.url, 'export_dir': export_dir, 'format': format,
+                               'mode': mode, 'workers': args.workers, 'page_size': args.page_size,
+                               'concurrency': args.concurrency}
+                    if MODES[mode].get('prime'):
+                        run_export(server, options)
+                    stats = run_export(server, options)
+                stats.update({'format': format, 'mode': mode, 'items': library.item_count,
+                              'items_per_sec': library.item_count / stats['wall']})
+                results.append(stats)
+                print(f"{format:<14} {mode:<12} {stats['items']:>8} items {stats['wall']:>8.2f}s "
+                      f"{stats['items_per_sec']:>9.0f} items/s {stats['requests']:>7} requests "
+                      f"{stats['bytes'] / 1024 ** 2:>8.1f} MiB {stats['peak_rss_mib']:>7.1f} MiB RSS")
+    finally:
+        server.stop()
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark plexport exports against a local fake Plex server.')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--movies', type=int, default=2000)
+    parser.add_argument('--shows', type=int, default=200)
+    parser.add_argument('--seasons', type=int, default=3,
+                        help='Seasons per show')
+    parser.add_argument('--episodes', type=int, default=10,
+                        help='Episodes per season')
+    parser.add_argument('--artists', type=int, default=200)
+    parser.add_argument('--albums', type=int, default=3,
+                        help='Albums per artist')
+    parser.add_argument('--tracks', type=int, default=10,
+                        help='Tracks per album')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Added latency per request in milliseconds')
+    parser.add_argument('--gzip', action='store_true',
+                        help='Serve gzip compressed responses like Plex')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='Share of requests the server fails with 503, to measure retries')
+    parser.add_argument('--formats', default=','.join(FORMATS),
+                        help='Comma separated formats; join formats with + to write them from one pass, e.g. csv+xlsx')
+    parser.add_argument('--modes', default=','.join(MODES),
+                        help=f"Comma separated modes out of {', '.join(MODES)}")
+    parser.add_argument('--stats', action='store_true',
+                        help='Also time the media statistics report; pass --formats "" to time only that')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--page-size', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=64,
+                        help='Requests in flight for the async mode')
+    parser.add_argument('--json', help='Write the results to this JSON file')
+    args = parser.parse_args()
+    if args.child:
+        run_child(json.loads(args.child))
+    else:
+        run_benchmarks(args)
+
+
+if __name__ == '__main__':
+    main()
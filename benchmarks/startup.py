@@ -0,0 +1,72 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COMMANDS = [['--help'], ['init', '--help'], ['export', '--help']]
+# coloredlogs is expected: every subcommand sets up logging.
+HEAVY_MODULES = ['plexapi', 'openpyxl', 'pkg_resources']
+
+CHILD = """
+import json, sys
+modules = json.loads(sys.argv[2])
+sys.argv = ['plexport'] + json.loads(sys.argv[1])
+from app.cli import cli_entry
+try:
+    cli_entry()
+except SystemExit:
+    pass
+print(json.dumps([name for name in modules if name in sys.modules]), file=sys.stderr)
+"""
+
+
+def time_command(argv, env):
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, '-c', CHILD, json.dumps(argv), json.dumps(HEAVY_MODULES)],
+                            cwd=ROOT, env=env, check=True, capture_output=True, text=True)
+    elapsed = (time.perf_counter() - started) * 1000
+    return elapsed, json.loads(result.stderr.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure plexport CLI startup time.')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--max-ms', type=float,
+                        help='Exit non-zero if any median startup time exceeds this many milliseconds')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as log_dir:
+        env = {**os.environ, 'LOG_DIR': log_dir, 'LOG_LEVEL': 'warning'}
+        interpreter = [(time.perf_counter(), subprocess.run([sys.executable, '-c', 'pass'], check=True),
+                        time.perf_counter()) for _ in range(args.runs)]
+        baseline = statistics.median(
+            (end - start) * 1000 for start, _, end in interpreter)
+        print(f"{'python -c pass':<24} {baseline:>8.1f} ms median")
+
+        failed = False
+        # The first run warms the dependency check marker.
+        time_command(COMMANDS[0], env)
+        for argv in COMMANDS:
+            timings = []
+            loaded = []
+            for _ in range(args.runs):
+                elapsed, loaded = time_command(argv, env)
+                timings.append(elapsed)
+            median = statistics.median(timings)
+            print(f"{'plexport ' + ' '.join(argv):<24} {median:>8.1f} ms median "
+                  f"{min(timings):>8.1f} ms min  heavy imports: {', '.join(loaded) or 'none'}")
+            if args.max_ms is not None and median > args.max_ms:
+                failed = True
+            if loaded:
+                failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,4 +2,6 @@
 from app.cli import cli_entry
 
 
-cli_entry()
+# XLSX sinks start worker processes that import this module again.
+if __name__ == '__main__':
+    cli_entry()
@@ -3,13 +3,16 @@ from setuptools import setup, find_packages
 setup(
     name='plexport',
     version='0.1',
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks']),
     entry_points={
         'console_scripts': [
             'plexport = app.cli:cli_entry',
         ],
     },
     install_requires=[
-        "plexapi", "coloredlogs", "openpyxl"
+        "plexapi", "coloredlogs", "openpyxl", "numpy"
     ],
+    extras_require={
+        'async': ['aiohttp'],
+    },
 )